@@ -1,6 +1,224 @@
-from collections import defaultdict
+import builtins
+import io
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 from fractions import Fraction
-from itertools import product
+from functools import cmp_to_key, wraps
+from itertools import cycle
+from math import ceil, comb, inf, isqrt, lcm, log2, prod
+from operator import attrgetter
+from random import Random
+from weakref import WeakValueDictionary
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Table of every live `Expression`, keyed by `(type, operands)`.
+# Structurally identical expressions are shared, so equality is an identity check.
+_INTERNED = WeakValueDictionary()
+
+# Rank of each expression type in the canonical ordering of operands.
+_ORDER = {"N": 0, "A": 1, "S": 2, "P": 3, "M": 4}
+
+_sort_key = attrgetter("_key")
+
+# Bit of the free-symbol mask shared by every symbol that is not a single letter a-z.
+_OTHER_SYMBOLS = 1 << 26
+
+# When set, every expression built through the trusted constructor is checked against
+# the full simplification.
+DEBUG = False
+
+# Default number of results kept by the memoisation layer of `Expression` operations.
+MEMO_SIZE = 4096
+
+
+class Memo:
+    """
+    Bounded least-recently-used cache of the results of `Expression` operations.
+
+    Entries are keyed by the operation name, the expression and the arguments.
+    Since expressions are interned, a lookup costs one hash of precomputed values and identity checks.
+    """
+
+    def __init__(self, max_entries=MEMO_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, key):
+        """Returns the cached result for `key` and marks it as recently used, or None if it is missing."""
+        result = self.entries.get(key)
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return result
+
+    def store(self, key, result):
+        """Caches a result, evicting the least recently used entry when the cache is full."""
+        self.entries[key] = result
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Removes every entry and resets the statistics."""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self):
+        """Returns the hit and miss counts and the current size of the cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": len(self.entries),
+            "max_entries": self.max_entries,
+        }
+
+
+MEMO = Memo()
+
+
+def configure_memo(max_entries=MEMO_SIZE):
+    """
+    Sets the capacity of the memoisation layer and empties it. A capacity of 0 disables it.
+    Running worker processes are stopped, to be started again with the new capacity.
+    """
+    MEMO.max_entries = max_entries
+    MEMO.clear()
+    PARALLEL.shutdown()
+
+
+# Mersenne primes modulo which polynomial identities are tested, in the order they are
+# tried.
+_IDENTITY_PRIMES = (2**61 - 1, 2**89 - 1, 2**107 - 1, 2**127 - 1)
+
+
+class IdentityTest:
+    """
+    Configuration of the probabilistic identity test used by `Expression.equivalent`.
+
+    An `error_bound` of 0 disables the test, so that expressions are only equal when they have the same canonical form.
+    The random points are drawn from a generator seeded with `seed`, so that runs are reproducible.
+    """
+
+    def __init__(self, error_bound=0, seed=0):
+        self.error_bound = error_bound
+        self.random = Random(seed)
+
+
+IDENTITY = IdentityTest()
+
+
+def configure_identity(error_bound=0, seed=0):
+    """Sets the probability bound of wrongly reporting two polynomials equal and reseeds the random points."""
+    # The negation also rejects NaN
+    if error_bound != 0 and not 0 < error_bound < 1:
+        raise ValueError(
+            f"Identity error bound must be 0 or between 0 and 1, but got {error_bound}."
+        )
+    IDENTITY.error_bound = error_bound
+    IDENTITY.random.seed(seed)
+
+
+# Default number of operands a sum needs before its operands are sent to the process pool.
+PARALLEL_THRESHOLD = 256
+
+
+class ParallelPool:
+    """
+    Process pool sharing the operands of large sums between workers
+    in `expand`, `simple_derive` and `substitute_all`.
+
+    With a single worker, or for sums with fewer than `threshold` operands,
+    the work stays in the current process.
+    """
+
+    def __init__(self, workers=1, threshold=PARALLEL_THRESHOLD):
+        self.workers = workers
+        self.threshold = threshold
+        self.executor = None
+
+    def map(self, expr, name, *args):
+        """
+        Applies the `Expression` method `name` to every operand of the sum `expr`,
+        split into one contiguous shard per worker, and returns the results in order.
+        Returns None when the sum is too small to be worth sending to the pool.
+        """
+        operands = expr.operands
+        if self.workers <= 1 or len(operands) < self.threshold:
+            return None
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(
+                self.workers, initializer=_start_worker, initargs=(MEMO.max_entries,)
+            )
+
+        size = -(-len(operands) // self.workers)
+        futures = [
+            self.executor.submit(_apply, name, operands[i : i + size], args)
+            for i in range(0, len(operands), size)
+        ]
+        return [result for future in futures for result in future.result()]
+
+    def shutdown(self):
+        """Stops the worker processes, which are started again when needed."""
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+PARALLEL = ParallelPool()
+
+
+def configure_parallel(workers=1, threshold=PARALLEL_THRESHOLD):
+    """Sets the number of worker processes and the size of the sums sent to them."""
+    if workers != PARALLEL.workers:
+        PARALLEL.shutdown()
+    PARALLEL.workers = workers
+    PARALLEL.threshold = threshold
+
+
+def _start_worker(memo_size):
+    """Configures a worker process of `PARALLEL` like the process that started it."""
+    MEMO.max_entries = memo_size
+    MEMO.clear()
+    # Workers do not start pools of their own, nor stop the pool copied from a fork
+    PARALLEL.workers = 1
+    PARALLEL.executor = None
+
+
+def _apply(name, operands, args):
+    """Applies an `Expression` method to each of the operands, in a worker of `PARALLEL`."""
+    return [getattr(operand, name)(*args) for operand in operands]
+
+
+def _memoized(method):
+    """Caches the results of an `Expression` method in `MEMO`. Leaves are cheap to process and are not cached."""
+    name = method.__name__
+
+    @wraps(method)
+    def wrapper(self, *args):
+        if not MEMO.max_entries or self.type in ("N", "S"):
+            return method(self, *args)
+
+        key = (
+            name,
+            self,
+            *(tuple(a.items()) if type(a) is dict else a for a in args),
+        )
+        result = MEMO.lookup(key)
+        if result is None:
+            result = method(self, *args)
+            MEMO.store(key, result)
+        return result
+
+    return wrapper
 
 
 def add(*a):
@@ -28,23 +246,239 @@ def sym(s):
     return Expression("S", s)
 
 
+def _symbol_bit(s):
+    """Returns the bit representing the symbol `s` in a free-symbol mask."""
+    if len(s) == 1 and "a" <= s <= "z":
+        return 1 << (ord(s) - ord("a"))
+    return _OTHER_SYMBOLS
+
+
+def _float(n):
+    """Converts a rational number to a float, rounding magnitudes beyond its range to infinity."""
+    try:
+        return float(n)
+    except OverflowError:
+        return inf if n > 0 else -inf
+
+
+def _float_array(values, dtype):
+    """Converts values to a NumPy float array, rounding magnitudes beyond its range to infinity."""
+    try:
+        return numpy.asarray(values, dtype=dtype)
+    except OverflowError:
+        return numpy.asarray([_float(v) for v in values], dtype=dtype)
+
+
+def _compare_keys(a, b):
+    """
+    Compares two sort keys like tuple comparison, returning -1, 0 or 1.
+    The nested keys are walked with an explicit stack, so deep expressions do not exceed
+    the recursion limit of Python's tuple comparison.
+    """
+    stack = [(a, b, 0)]
+    while stack:
+        a, b, i = stack.pop()
+        # Keys of shared subtrees are the same tuple
+        if a is b:
+            continue
+        if i == len(a) or i == len(b):
+            if len(a) != len(b):
+                return -1 if len(a) < len(b) else 1
+            continue
+
+        stack.append((a, b, i + 1))
+        x, y = a[i], b[i]
+        if type(x) is tuple:
+            stack.append((x, y, 0))
+        elif x != y:
+            return -1 if x < y else 1
+    return 0
+
+
+def _sorted(items, key=_sort_key):
+    """
+    Sorts items by their canonical sort key, falling back to `_compare_keys`
+    when the keys are too deep for tuple comparison.
+    """
+    try:
+        return sorted(items, key=key)
+    except RecursionError:
+        return sorted(items, key=cmp_to_key(lambda a, b: _compare_keys(key(a), key(b))))
+
+
+def _normal_form(expr_type, operands):
+    """
+    Computes the normal-form flags of a node from its operands:
+    whether `expand` returns the node itself, and its total degree if it is a polynomial, otherwise -1.
+    """
+    match expr_type:
+        case "N":
+            return True, 0
+        case "S":
+            return True, 1
+        case "A":
+            expanded = all(operand._expanded for operand in operands)
+            degrees = [operand._degree for operand in operands]
+            return expanded, -1 if -1 in degrees else max(degrees)
+        case "M":
+            expanded = all(
+                operand._expanded and operand.type != "A" for operand in operands
+            )
+            degrees = [operand._degree for operand in operands]
+            return expanded, -1 if -1 in degrees else sum(degrees)
+        case "P":
+            base, exponent = operands
+            if exponent.type != "N":
+                return base._expanded and exponent._expanded, -1
+
+            exponent = exponent[0]
+            if type(exponent) is int and exponent > 0:
+                return (
+                    base.type == "S",
+                    base._degree * exponent if base._degree >= 0 else -1,
+                )
+
+            expanded = base.type == "S" or (
+                abs(exponent.numerator) == 1 and base._expanded
+            )
+            return expanded, -1
+
+
+# Largest number of operands joined in one statement by `Expression.compile`, as Python's
+# compiler recurses into each binary operation of a statement.
+_COMPILE_CHUNK = 256
+
+# Number of printed pieces buffered by `Expression.write` before they are written to the
+# stream.
+_PRINT_CHUNK = 4096
+
+
+def _parenthesized(expr, types):
+    """Returns the items printing an expression, wrapped in parentheses if its type is one of `types`."""
+    return ["(", expr, ")"] if expr.type in types else [expr]
+
+
+def _is_division(factor):
+    """Checks if a factor of a product is a power with exponent at most -1, printed as a division."""
+    return factor.type == "P" and factor[1].type == "N" and factor[1][0] <= -1
+
+
+def _denominator(power):
+    """Returns the items printing the denominator of a power with exponent at most -1."""
+    den = pow(power[0], abs(power[1][0]))
+    return [den] if den.type in ("P", "N", "S") else ["(", den, ")"]
+
+
+def _starts_with_minus(factor):
+    """Checks if the printed factor of a product starts with a minus sign, which is the case of a negative base."""
+    return (
+        factor.type == "P"
+        and factor[0].type == "N"
+        and factor[0][0] < 0
+        and not _is_division(factor)
+    )
+
+
+def scale(expr, c):
+    """Multiplies an expression by a rational number without simplifying it again."""
+    c = rational(c)
+    if c == 0:
+        return num(0)
+    if c == 1:
+        return expr
+
+    match expr.type:
+        case "N":
+            return num(c * expr[0])
+        case "M" if expr[0].type == "N":
+            c *= expr[0][0]
+            if c == 1:
+                return (
+                    expr[1]
+                    if len(expr.operands) == 2
+                    else Expression._make("M", *expr[1:])
+                )
+            return Expression._make("M", num(c), *expr[1:])
+        case "M":
+            return Expression._make("M", num(c), *expr.operands)
+        case _:
+            return Expression._make("M", num(c), expr)
+
+
+def rational(n):
+    """Normalizes a number to an `int` when it is integral, otherwise to a `Fraction`."""
+    if type(n) is int:
+        return n
+    n = Fraction(n)
+    return n.numerator if n.denominator == 1 else n
+
+
+def _integer_root(n, k):
+    """Returns the `k`-th root of a non-negative integer if it is an integer, otherwise `None`."""
+    if n < 2:
+        return n
+    if k == 2:
+        root = isqrt(n)
+    else:
+        # Newton's iteration from a power of two above the root decreases to its floor
+        root = 1 << -(-n.bit_length() // k)
+        while True:
+            step = ((k - 1) * root + n // root ** (k - 1)) // k
+            if step >= root:
+                break
+            root = step
+    return root if root**k == n else None
+
+
+def rational_pow(base, exponent):
+    """
+    Raises a rational number to a rational power, keeping the result exact for integer exponents
+    and for roots of perfect powers.
+    """
+    if type(exponent) is int and exponent >= 0:
+        return rational(base**exponent)
+
+    base, exponent = Fraction(base), Fraction(exponent)
+    root = exponent.denominator
+    if root > 1 and (base >= 0 or root % 2 == 1):
+        numerator = _integer_root(abs(base.numerator), root)
+        denominator = _integer_root(base.denominator, root)
+        if numerator is not None and denominator is not None:
+            base = Fraction(numerator if base >= 0 else -numerator, denominator)
+            return rational(base**exponent.numerator)
+    return rational(base**exponent)
+
+
 class Expression:
-    def __init__(self, expr_type, *operands) -> None:
+    __slots__ = (
+        "__weakref__",
+        "_cache",
+        "_degree",
+        "_expanded",
+        "_hash",
+        "_key",
+        "_symbols",
+        "operands",
+        "type",
+    )
+
+    def __new__(cls, expr_type, *operands):
         """
-        Initializes an `Expression` object based on the given type and operands.
-        The expression is automatically simplified.
+        Creates an `Expression` object based on the given type and operands.
+        The expression is automatically simplified and interned, so structurally
+        identical expressions are always the same object.
         """
 
-        self.type = expr_type.upper()
-        self.operands = []
+        expr_type = expr_type.upper()
+        new_operands = []
         for op in operands:
             match op:
                 case int() | float() | Fraction():
-                    self.operands.append(Fraction(op) if self.type == "N" else num(op))
+                    new_operands.append(rational(op) if expr_type == "N" else num(op))
                 case str():
-                    self.operands.append(op if self.type == "S" else sym(op))
+                    new_operands.append(op if expr_type == "S" else sym(op))
                 case Expression():
-                    self.operands.append(op)
+                    new_operands.append(op)
                 case _:
                     print(
                         "ERROR in Expression: Unknown type",
@@ -53,142 +487,184 @@ class Expression:
                         type(op),
                     )
 
-        match self.type:
+        match expr_type:
             case "P":
-                base = self.operands[0]
-                exponent = self.operands[1]
+                base = new_operands[0]
+                exponent = new_operands[1]
 
                 if base.type == "N" and exponent.type == "N":
-                    return self.init_num(base[0] ** exponent[0])
+                    return cls._num(rational_pow(base[0], exponent[0]))
 
                 if base.type == "P" and base[1].type == "N" and exponent.type == "N":
-                    return self.init_pow(base[0], num(base[1][0] * exponent[0]))
+                    return pow(base[0], base[1][0] * exponent[0])
 
                 match exponent:
                     case 0:
-                        return self.init_num(1)
+                        return cls._num(1)
                     case 1:
-                        return self.init_copy(base)
+                        return base
 
                 match base:
                     case 0:
-                        return self.init_num(0)
+                        return cls._num(0)
                     case 1:
-                        return self.init_num(1)
+                        return cls._num(1)
 
-                return self.init_pow(base, exponent)
+                return cls._intern("P", base, exponent)
 
             case "M":
-                operands = self.operands.copy()
-                numbers = num(1)
-                powers = defaultdict(lambda: num(0))
+                coefficient = 1
+                exponents = {}
+                symbolic_exponents = {}
 
-                for operand in operands:
-                    operand = operand
-
-                    match operand.type:
-                        case "N":
-                            if operand == 0:
-                                return self.init_num(0)
-                            numbers = num(numbers[0] * operand[0])
-                        case "A" | "S":
-                            powers[operand] = add(powers[operand], 1)
-                        case "P":
-                            powers[operand[0]] = add(powers[operand[0]], operand[1])
-                        case "M":
-                            operands += operand.operands
+                for operand in new_operands:
+                    for factor in (
+                        operand.operands if operand.type == "M" else (operand,)
+                    ):
+                        match factor.type:
+                            case "N":
+                                if factor[0] == 0:
+                                    return cls._num(0)
+                                coefficient *= factor[0]
+                            case "A" | "S":
+                                exponents[factor] = exponents.get(factor, 0) + 1
+                            case "P":
+                                base, exponent = factor.operands
+                                if exponent.type == "N":
+                                    exponents[base] = (
+                                        exponents.get(base, 0) + exponent[0]
+                                    )
+                                else:
+                                    exponents.setdefault(base, 0)
+                                    symbolic_exponents.setdefault(base, []).append(
+                                        exponent
+                                    )
 
                 result = []
-                for base, exponent in powers.items():
+                for base, exponent in exponents.items():
+                    if base in symbolic_exponents:
+                        exponent = add(exponent, *symbolic_exponents[base])
+
                     if exponent == 1:
-                        result += [base]
+                        factor = base
                     elif exponent != 0:
-                        result += [pow(base, exponent)]
+                        factor = pow(base, exponent)
+                    else:
+                        continue
+
+                    if factor.type == "N":
+                        coefficient *= factor[0]
+                    else:
+                        result += [factor]
+
+                coefficient = rational(coefficient)
 
                 if result == []:
-                    return self.init_copy(numbers)
-                elif len(result) == 1 and numbers == 1:
-                    return self.init_copy(result[0])
+                    return cls._num(coefficient)
+                elif len(result) == 1 and coefficient == 1:
+                    return result[0]
 
-                result += [numbers] if numbers != 1 else []
+                result += [cls._num(coefficient)] if coefficient != 1 else []
 
-                return self.init_mul(*sorted(result))
+                return cls._intern("M", *_sorted(result))
 
             case "A":
-                operands = self.operands.copy()
-                numbers = num(0)
-                muls = defaultdict(lambda: 0)
-
-                for operand in operands:
-                    match operand.type:
-                        case "N":
-                            numbers = num(numbers[0] + operand[0])
-                        case "M":
-                            n = [i for i in operand.operands if i.type == "N"]
-
-                            if n == []:
-                                n = 1
-                            else:
-                                n = n[0][0]
-
-                            not_n = [i for i in operand.operands if i.type != "N"]
-
-                            if len(not_n) == 1:
-                                not_n = not_n[0]
-                            else:
-                                not_n = mul(*not_n)
-
-                            muls[not_n] += n
-                        case "P" | "S":
-                            muls[operand] += 1
-                        case "A":
-                            operands += operand.operands
+                constant = 0
+                terms = {}
+
+                for operand in new_operands:
+                    for term in operand.operands if operand.type == "A" else (operand,):
+                        match term.type:
+                            case "N":
+                                constant += term[0]
+                            case "M" if term[0].type == "N":
+                                factors = term.operands[1:]
+                                terms[factors] = terms.get(factors, 0) + term[0][0]
+                            case "M":
+                                factors = term.operands
+                                terms[factors] = terms.get(factors, 0) + 1
+                            case _:
+                                factors = (term,)
+                                terms[factors] = terms.get(factors, 0) + 1
 
                 result = []
-                for value, times in muls.items():
-                    if times == 1:
-                        result += [value]
-                    elif times != 0:
-                        result += [mul(times, value)]
+                for factors, times in terms.items():
+                    if times == 0:
+                        continue
+
+                    if len(factors) == 1:
+                        value = factors[0]
+                    else:
+                        value = cls._make("M", *factors)
+
+                    result += [value if times == 1 else scale(value, times)]
 
-                result += [numbers] if numbers != 0 else []
+                result += [cls._num(constant)] if constant != 0 else []
 
                 if len(result) == 1:
-                    return self.init_copy(result[0])
+                    return result[0]
                 elif len(result) == 0:
-                    return self.init_num(0)
+                    return cls._num(0)
 
-                return self.init_add(*sorted(result))
+                return cls._intern("A", *_sorted(result))
 
             case "N" | "S":
-                pass
+                return cls._intern(expr_type, *new_operands)
 
             case _:
-                print("ERROR OPERANDS", self.type)
-
-    def init_copy(self, expr):
-        """Copies the type and operands from another expression into the current one."""
-        self.type, self.operands = expr.type, expr.operands
-
-    def init_add(self, *a):
-        """Initializes the current expression as an addition expression."""
-        self.type, self.operands = "A", list(a)
-
-    def init_mul(self, *m):
-        """Initializes the current expression as a multiplication expression."""
-        self.type, self.operands = "M", list(m)
-
-    def init_pow(self, *p):
-        """Initializes the current expression as a power expression."""
-        self.type, self.operands = "P", list(p)
+                print("ERROR OPERANDS", expr_type)
 
-    def init_num(self, n):
-        """Initializes the current expression as a numeric expression."""
-        self.type, self.operands = "N", [Fraction(n)]
+    @classmethod
+    def _intern(cls, expr_type, *operands):
+        """
+        Returns the shared expression with the given type and operands, creating it if needed.
+        The operands must already be in simplified form.
+        """
+        key = (expr_type, operands)
+        expr = _INTERNED.get(key)
+        if expr is None:
+            expr = object.__new__(cls)
+            expr.type, expr.operands = expr_type, operands
+            expr._hash = hash(key)
+            if expr_type in ("N", "S"):
+                expr._key = (_ORDER[expr_type], *operands)
+                expr._symbols = _symbol_bit(operands[0]) if expr_type == "S" else 0
+            else:
+                expr._key = (_ORDER[expr_type], *map(_sort_key, operands))
+                expr._symbols = 0
+                for operand in operands:
+                    expr._symbols |= operand._symbols
+            expr._expanded, expr._degree = _normal_form(expr_type, operands)
+            expr._cache = None
+            _INTERNED[key] = expr
+        return expr
+
+    @classmethod
+    def _make(cls, expr_type, *operands):
+        """
+        Builds an expression from operands that already form a simplified node, skipping simplification.
+        When `DEBUG` is set, the result is checked against the full constructor.
+        """
+        expr = cls._intern(expr_type, *operands)
+        assert not DEBUG or Expression(expr_type, *operands) is expr, (
+            f"Trusted construction of {expr_type}{operands} is not simplified"
+        )
+        return expr
+
+    @classmethod
+    def _num(cls, n):
+        """Returns the shared numeric expression for the given value."""
+        return cls._intern("N", rational(n))
+
+    def __reduce__(self):
+        """
+        Rebuilds the expression through the interning table when copied or pickled.
+        It is pickled in its serialized form, which stores shared subtrees once
+        and does not recurse into deep expressions.
+        """
+        from src.interpreter import serialization
 
-    def init_sym(self, s):
-        """Initializes the current expression as a symbolic expression."""
-        self.type, self.operands = "S", [s]
+        return (serialization.loads, (serialization.dumps(self),))
 
     def __getitem__(self, key):
         """Accesses the operand at the specified index."""
@@ -200,110 +676,147 @@ class Expression:
 
     def print_tree(self, verbous=False):
         """Prints the expression in a tree-like structure with the option for verbose output."""
-        if self.type in ("N", "S"):
-            return f"{self.type}({self[0]})" if verbous else str(self[0])
-        else:
-            return f"{self.type}({', '.join(map(lambda x: x.print_tree(verbous), self.operands))})"
+        parts = []
+
+        # The stack holds the expressions still to print and the separators between them
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if type(item) is str:
+                parts.append(item)
+            elif item.type in ("N", "S"):
+                parts.append(f"{item.type}({item[0]})" if verbous else str(item[0]))
+            else:
+                parts.append(f"{item.type}(")
+                stack.append(")")
+                operands = item.operands
+                for i in range(len(operands) - 1, 0, -1):
+                    stack.append(operands[i])
+                    stack.append(", ")
+                stack.append(operands[0])
+
+        return "".join(parts)
 
     def print(self):
         """Returns the string representation of the expression similar to the one common used in math."""
-        order = ["A", "M", "P", "N", "S"]
-        index = order.index(self.type)
+        if self.type in ("N", "S"):
+            return str(self[0])
 
-        match self.type:
-            case "N" | "S":
-                return str(self[0])
+        buffer = io.StringIO()
+        self.write(buffer)
+        return buffer.getvalue()
+
+    def write(self, stream):
+        """
+        Writes the string representation of the expression to a text stream, as returned by `print`.
 
+        The output is produced left to right from an explicit stack of pending expressions and strings,
+        and written in chunks, so it takes linear time and never holds the whole string in memory.
+        """
+        parts = []
+
+        stack = [self]
+        while stack:
+            item = stack.pop()
+            if type(item) is str:
+                parts.append(item)
+            elif type(item) is tuple:
+                stack.extend(reversed(item[0]._print_mul(negated=True)))
+            elif item.type in ("N", "S"):
+                parts.append(str(item.operands[0]))
+            else:
+                stack.extend(reversed(item._print_items()))
+
+            if len(parts) >= _PRINT_CHUNK:
+                stream.write("".join(parts))
+                parts.clear()
+
+        stream.write("".join(parts))
+
+    def _print_items(self):
+        """
+        Returns what prints the current sum, product or power, in order: strings to output as they are,
+        expressions to print, and 1-tuples holding a product to print with its coefficient negated.
+        """
+        match self.type:
             case "A":
-                operand_str = self.operands[0].print()
-                result = (
-                    operand_str
-                    if order.index(self[0].type) > index
-                    else f"({operand_str})"
-                )
-                for operand in self.operands[1:]:
-                    operand_str = operand.print()
+                first = self.operands[0]
+                items = ["(", first, ")"] if first.type == "A" else [first]
 
+                for operand in self.operands[1:]:
                     if operand.type == "N" and operand[0] < 0:
-                        operand_str = f" - {abs(operand[0])}"
+                        items.append(f" - {abs(operand[0])}")
                     elif (
                         operand.type == "M"
                         and operand[0].type == "N"
                         and operand[0][0] < 0
                     ):
-                        operand_str = f" - {operand_str[3:] if operand[0][0] == -1 else operand_str[1:]}"
+                        items += [" - ", (operand,)]
                     elif (
                         operand.type == "P"
                         and operand[0].type == "N"
                         and operand[0][0] < 0
                     ):
-                        operand_str = f" - {operand_str[1:]}"
+                        items += [
+                            " - ",
+                            str(abs(operand[0][0])),
+                            "^",
+                            *_parenthesized(operand[1], "AMP"),
+                        ]
+                    elif operand.type == "A":
+                        items += [" + (", operand, ")"]
                     else:
-                        operand_str = f" + {operand_str}"
+                        items += [" + ", operand]
 
-                    result += (
-                        operand_str
-                        if order.index(operand.type) > index
-                        else f"{operand_str[:3]}({operand_str[3:]})"
-                    )
-
-                return result
+                return items
 
             case "M":
-                operand_str = self.operands[0].print()
-                result = (
-                    operand_str
-                    if order.index(self[0].type) > index
-                    else f"({operand_str})"
-                )
-                for operand in self.operands[1:]:
-                    operand_str = operand.print()
-
-                    if (
-                        operand.type == "P"
-                        and operand[1].type == "N"
-                        and operand[1][0] <= -1
-                    ):
-                        den = pow(operand[0], abs(operand[1][0]))
-                        operand_str = (
-                            f"/{den if den.type in ['P', 'N', 'S'] else f'({den})'}"
-                        )
-                    else:
-                        operand_str = f" * {operand_str}"
+                return self._print_mul()
 
-                    result += (
-                        operand_str
-                        if order.index(operand.type) > index
-                        else f"{operand_str[:3]}({operand_str[3:]})"
-                    )
-
-                if result.startswith("-1 * -"):
-                    result = result.replace("-1 * ", "+", 1)
-                if result.startswith("-1 * "):
-                    result = result.replace("-1 * ", "-", 1)
+            case "P":
+                base, exponent = self.operands
+                if exponent.type == "N" and exponent[0] <= -1:
+                    return ["1/", *_denominator(self)]
+                return [
+                    *_parenthesized(base, "AMP"),
+                    "^",
+                    *_parenthesized(exponent, "AMP"),
+                ]
+
+    def _print_mul(self, negated=False):
+        """Returns the items printing the current product, as `_print_items`, optionally with its coefficient negated."""
+        factors = self.operands
+        coefficient = None
+        if factors[0].type == "N":
+            coefficient = -factors[0][0] if negated else factors[0][0]
+            factors = factors[1:]
+
+        items = []
+        if coefficient is None or coefficient == 1:
+            items += _parenthesized(factors[0], "AM")
+            factors = factors[1:]
+        elif coefficient == -1 and not _is_division(factors[0]):
+            # A coefficient of -1 is written as a sign, which cancels a leading minus of
+            # the next factor
+            items += [
+                "+" if _starts_with_minus(factors[0]) else "-",
+                *_parenthesized(factors[0], "AM"),
+            ]
+            factors = factors[1:]
+        else:
+            items.append(str(coefficient))
 
-                return result
+        for factor in factors:
+            if _is_division(factor):
+                items += ["/", *_denominator(factor)]
+            else:
+                items += [" * ", *_parenthesized(factor, "AM")]
 
-            case "P":
-                base = self.operands[0]
-                exp = self.operands[1]
-
-                if exp.type == "N" and exp[0] <= -1:
-                    den = pow(base, abs(exp[0]))
-                    return f"1/{den if den.type in ['P', 'N', 'S'] else f'({den})'}"
-
-                return "^".join(
-                    map(
-                        lambda x: x.print()
-                        if order.index(x.type) > index
-                        else f"({x.print()})",
-                        self.operands,
-                    )
-                )
+        return items
 
     def __hash__(self) -> int:
-        """Returns the hash value for the expression."""
-        return str(self).__hash__()
+        """Returns the structural hash of the expression, computed once when it is created."""
+        return self._hash
 
     def __eq__(self, value: object) -> bool:
         """Checks if the current expression is equal to the given value."""
@@ -313,95 +826,206 @@ class Expression:
             case str():
                 return self.type == "S" and self[0] == value
             case Expression():
-                return self.type == value.type and self.operands == value.operands
+                return self is value
 
     def __lt__(self, value: object) -> bool:
-        """Checks if the current expression is less than the given value."""
-        order = ["N", "A", "S", "P", "M"]
+        """
+        Checks if the current expression is less than the given value.
+        Expressions are compared through their canonical sort key, computed once when they are created.
+        """
         if type(value) is Expression:
-            if order.index(self.type) == order.index(value.type):
-                return self.operands < value.operands
-            else:
-                return order.index(self.type) < order.index(value.type)
+            try:
+                return self._key < value._key
+            except RecursionError:
+                return _compare_keys(self._key, value._key) < 0
 
     def __le__(self, value: object) -> bool:
         """Checks if the current expression is less than or equal to the given value."""
         return self < value or self == value
 
-    def expand(self):
-        """Expands the current expression by applying the algebraic properties of sums, products and powers."""
-
-        def expand_pow(self):
-            if self[1].type == "N":
-                numerator, denominator = self[1][0].as_integer_ratio()
-
-                if numerator < 0:
-                    numerator *= -1
-                    denominator *= -1
+    def equivalent(self, value):
+        """
+        Checks whether two expressions are equal, also when they are polynomials written in different forms.
 
-                base = expand_mul([self[0]] * numerator)
+        When `IDENTITY` is enabled, polynomials are compared with the Schwartz-Zippel test: both are evaluated at random
+        points modulo large primes, where two different polynomials of total degree d agree with probability at most d/p.
+        Points are drawn until the probability of a wrong answer is within the error bound.
+        Any other expression is only equal to itself.
+        """
+        if self is value:
+            return True
+
+        degree = max(self._degree, value._degree)
+        if (
+            not IDENTITY.error_bound
+            or self._degree < 0
+            or value._degree < 0
+            or degree == 0
+        ):
+            return False
+
+        symbols = sorted(self.find_symbols() | value.find_symbols())
+        error = 1
+        failures = 0
+        for modulus in cycle(_IDENTITY_PRIMES):
+            point = [(symbol, IDENTITY.random.randrange(modulus)) for symbol in symbols]
+            try:
+                if self._evaluate_modulo(point, modulus) != value._evaluate_modulo(
+                    point, modulus
+                ):
+                    return False
+            except ValueError:
+                # A denominator is a multiple of the prime, after one for each prime the
+                # expansions are compared instead
+                failures += 1
+                if failures == len(_IDENTITY_PRIMES):
+                    return self.expand() is value.expand()
+                continue
+
+            error *= degree / modulus
+            if error <= IDENTITY.error_bound:
+                return True
 
-                if self[1][0].denominator == 1:
-                    return base
-                else:
-                    return pow(base, 1 / denominator)
+    def expand(self):
+        """Expands the current expression by applying the algebraic properties of sums, products and powers."""
+        # Expressions already in expanded form are returned before looking up the memo
+        if self._expanded:
+            return self
+        return self._expand()
+
+    @_memoized
+    def _expand(self):
+        """Expands an expression that is not in expanded form, caching the result in `MEMO`."""
+        if self.type == "A":
+            expansions = PARALLEL.map(self, "expand")
+            if expansions is not None:
+                result = Polynomial.constant(0)
+                for expansion in expansions:
+                    result += Polynomial.from_expanded(expansion)
+                return result.to_expression()
+
+        return Polynomial.from_expression(self).to_expression()
+
+    @_memoized
+    def expand_modular(self):
+        """
+        Expands the current expression like `expand`, computing coefficients modulo primes.
+
+        The expansion is computed modulo enough primes below 2^62 to tell its coefficients
+        apart, as given by a bound on their size, so the arithmetic stays on word-sized
+        numbers however large the coefficients grow. Each coefficient is rebuilt with the
+        Chinese remainder theorem, followed by rational reconstruction when the expression
+        has fractions. Expressions that are not polynomials in single-letter symbols are
+        expanded with `expand`.
+        """
+        if self._expanded or self._degree < 0 or self._symbols & _OTHER_SYMBOLS:
+            return self.expand()
+
+        # A coefficient a/b has |a| at most 2^height * b, and is unique modulo a product
+        # of primes above 2 * |a| * b
+        height, denominator = _coefficient_bounds(self)
+        numerator_bound = denominator << max(ceil(height) + 1, 0)
+        bits = (2 * numerator_bound * denominator).bit_length()
+
+        moduli = []
+        images = []
+        product = 1
+        i = 0
+        while product.bit_length() <= bits:
+            modulus = _modular_prime(i)
+            i += 1
+            if denominator % modulus == 0:
+                continue
+
+            try:
+                image = Polynomial.from_expression(self, modulus)
+            except OverflowError:
+                return self.expand()
+
+            moduli.append(modulus)
+            images.append(image.terms)
+            product *= modulus
+
+        weights = [product // p * builtins.pow(product // p, -1, p) for p in moduli]
+        terms = {}
+        for monomial in set().union(*images):
+            c = (
+                sum(w * image.get(monomial, 0) for w, image in zip(weights, images))
+                % product
+            )
+            if denominator == 1:
+                terms[monomial] = c if 2 * c < product else c - product
             else:
-                return pow(*[e.expand() for e in self.operands])
-
-        def expand_mul(operands):
-            operands = operands.copy()
-            result = operands[0].expand()
-            for operand in operands[1:]:
-                operand = operand.expand()
-                if result.type == "A" and operand.type == "A":
-                    result = add(
-                        *[mul(*p) for p in product(result.operands, operand.operands)],
-                    )
-                elif result.type == "A" or operand.type == "A":
-                    addition, other = (
-                        (result, operand) if result.type == "A" else (operand, result),
-                    )[0]
-                    result = add(*[mul(a, other) for a in addition])
-                else:
-                    result = mul(result, operand)
+                terms[monomial] = _rational_reconstruction(c, product, numerator_bound)
 
-            return result
-
-        expand_table = {
-            "P": expand_pow,
-            "M": lambda node: expand_mul(node.operands),
-            "A": lambda node: add(*[e.expand() for e in node.operands]),
-            "S": lambda node: node,
-            "N": lambda node: node,
-        }
-        return expand_table[self.type](self)
+        return Polynomial(terms, True).to_expression()
 
     def substitute(self, match, subst):
         """Substitutes occurrences of a specified expression `match` within the current expression with a new expression `subst`."""
-        expr = Expression(self.type, *self.operands)
+        return self.substitute_all({match: subst})
 
-        for i in range(len(expr.operands)):
-            if expr[i] == match:
-                expr.operands[i] = subst
-            elif type(expr[i]) is Expression and expr[i].type in ("A", "M", "P"):
-                expr.operands[i] = expr[i].substitute(match, subst)
+    @_memoized
+    def substitute_all(self, mapping):
+        """
+        Substitutes simultaneously every expression in the keys of `mapping` with its value, in a single traversal.
+
+        Subtrees shared within the expression are rewritten once, and subtrees that cannot contain any key are returned as they are.
+        """
+        if self in mapping:
+            return mapping[self]
+
+        if self.type == "A":
+            operands = PARALLEL.map(self, "substitute_all", mapping)
+            if operands is not None:
+                if all(new is old for new, old in zip(operands, self.operands)):
+                    return self
+                return Expression("A", *operands)
+
+        masks = {match._symbols for match in mapping}
+        results = {}
+
+        stack = [(self, False)]
+        while stack:
+            expr, visited = stack.pop()
+            if expr in results:
+                continue
+            if expr in mapping:
+                results[expr] = mapping[expr]
+                continue
+            if expr.type in ("N", "S") or all(m & ~expr._symbols for m in masks):
+                results[expr] = expr
+                continue
+            if not visited:
+                stack.append((expr, True))
+                stack.extend((operand, False) for operand in expr.operands)
+                continue
+
+            operands = [results[operand] for operand in expr.operands]
+
+            if all(new is old for new, old in zip(operands, expr.operands)):
+                results[expr] = expr
+            else:
+                results[expr] = Expression(expr.type, *operands)
 
-        return Expression(expr.type, *expr.operands)
+        return results[self]
 
     def find_symbols(self):
         """Finds all symbols within the expression."""
-        if self.type == "S":
-            return self[0]
-        if self.type == "N":
-            return set()
+        if not self._symbols & _OTHER_SYMBOLS:
+            return {sym(chr(ord("a") + i)) for i in range(26) if self._symbols >> i & 1}
 
         symbols = set()
-        for operand in self.operands:
-            match operand.type:
-                case "S":
-                    symbols.add(operand)
-                case "P" | "M" | "A":
-                    symbols.update(operand.find_symbols())
+        stack = [self]
+        while stack:
+            expr = stack.pop()
+            if not expr._symbols & _OTHER_SYMBOLS:
+                symbols.update(
+                    sym(chr(ord("a") + i)) for i in range(26) if expr._symbols >> i & 1
+                )
+            elif expr.type == "S":
+                symbols.add(expr)
+            else:
+                stack.extend(expr.operands)
 
         return symbols
 
@@ -409,20 +1033,34 @@ class Expression:
         """
         Evaluates the expression by substituting the provided rational numbers for the symbols present in the expression.
 
-        It substitutes each symbol with its corresponding rational number in alphabetical order.
+        Each symbol, in alphabetical order, is paired with the corresponding rational number and all of them are substituted at once.
         For example, calling `Eval(y^x, 2, 3)` substitutes `x` with `2` and `y` with `3`, resulting in `3^2`, which evaluates to `9`.
         """
 
         symbol = sorted(self.find_symbols())
-        result = self
 
         if all(i.type != "N" for i in rat):
             raise Exception("Expected rational number")
 
         if len(symbol) == len(rat):
-            for i in range(len(symbol)):
-                result = result.substitute(symbol[i], rat[i])
-            return result
+            if all(i.type == "N" for i in rat):
+                # Only expanded polynomials, as expanding a compact power costs more than
+                # evaluating it
+                horner = self.horner() if self._expanded else None
+                if horner is not None:
+                    return num(horner(rat[0][0]))
+
+                # An expression evaluated more than once is compiled, and the compiled
+                # form is reused afterwards
+                cache = self._cached()
+                cache["evaluations"] = cache.get("evaluations", 0) + 1
+                if cache["evaluations"] > 1:
+                    return num(self.compile()(*(r[0] for r in rat)))
+
+                if self._degree >= 0:
+                    return num(self._evaluate(zip(symbol, (r[0] for r in rat))))
+
+            return self.substitute_all(dict(zip(symbol, rat)))
         elif len(symbol) < len(rat):
             raise Exception(
                 "Too much rational number to evaluate expression. "
@@ -434,51 +1072,1349 @@ class Expression:
                 + f"Expected {len(symbol)}, but got {len(rat)}."
             )
 
-    def simple_derive(self, sym):
-        """Calculates the derivative of the expression with respect to the given symbol."""
+    def _evaluate(self, values):
+        """Evaluates a polynomial expression given the value of each of its symbols, sharing repeated subtrees."""
+        results = dict(values)
+
+        stack = [(self, False)]
+        while stack:
+            expr, visited = stack.pop()
+            if expr in results:
+                continue
+            if expr.type == "N":
+                results[expr] = expr[0]
+                continue
+            if not visited:
+                stack.append((expr, True))
+                stack.extend((operand, False) for operand in expr.operands)
+                continue
+
+            match expr.type:
+                case "A":
+                    results[expr] = sum(results[operand] for operand in expr.operands)
+                case "M":
+                    results[expr] = prod(results[operand] for operand in expr.operands)
+                case "P":
+                    results[expr] = results[expr[0]] ** expr[1][0]
+
+        return results[self]
+
+    def _evaluate_modulo(self, values, modulus):
+        """
+        Evaluates a polynomial expression modulo a prime given the value of each of its symbols, sharing repeated subtrees.
+        Raises a ValueError when a denominator is a multiple of the prime.
+        """
+        results = dict(values)
+
+        stack = [(self, False)]
+        while stack:
+            expr, visited = stack.pop()
+            if expr in results:
+                continue
+            if expr.type == "N":
+                n = expr[0]
+                results[expr] = (
+                    n.numerator * builtins.pow(n.denominator, -1, modulus) % modulus
+                )
+                continue
+            if not visited:
+                stack.append((expr, True))
+                stack.extend((operand, False) for operand in expr.operands)
+                continue
+
+            match expr.type:
+                case "A":
+                    results[expr] = (
+                        sum(results[operand] for operand in expr.operands) % modulus
+                    )
+                case "M":
+                    result = 1
+                    for operand in expr.operands:
+                        result = result * results[operand] % modulus
+                    results[expr] = result
+                case "P":
+                    results[expr] = builtins.pow(results[expr[0]], expr[1][0], modulus)
+
+        return results[self]
+
+    def _cached(self):
+        """Returns the dictionary of values cached on the node, creating it on first use."""
+        if self._cache is None:
+            self._cache = {}
+        return self._cache
+
+    def horner(self):
+        """
+        Returns a function evaluating a univariate polynomial with Horner's scheme, or None for any other expression.
 
-        def derive_pow(self):
-            if self[1].type != "N":
-                raise Exception("Non-rational exponent in expression")
+        The polynomial is stored as its nonzero coefficients with the gaps between consecutive degrees.
+        Powers of the value for the distinct gaps are computed once per evaluation as a ladder, so sparse polynomials
+        do not pay for their missing terms, and dense ones take one multiplication per degree.
+        The function is cached on the node.
+        """
+        cache = self._cached()
+        if "horner" in cache:
+            return cache["horner"]
+
+        cache["horner"] = None
+        symbols = self.find_symbols()
+        if self._degree < 0 or len(symbols) != 1:
+            return None
+
+        coefficients = _sparse_coefficients(self.expand(), symbols.pop())
+        if coefficients is None:
+            return None
+
+        degrees = sorted(coefficients, reverse=True)
+        leading = coefficients[degrees[0]]
+        steps = [(a - b, coefficients[b]) for a, b in zip(degrees, degrees[1:])]
+        shift = degrees[-1]
+        ladder = sorted({gap for gap, _ in steps} | ({shift} if shift else set()))
+
+        def evaluate(value):
+            powers = {}
+            power, previous = 1, 0
+            for gap in ladder:
+                power *= value ** (gap - previous)
+                powers[gap], previous = power, gap
+
+            result = leading
+            for gap, c in steps:
+                result = result * powers[gap] + c
+            if shift:
+                result *= powers[shift]
+            return rational(result)
+
+        cache["horner"] = evaluate
+        return evaluate
+
+    def compile(self):
+        """
+        Compiles the expression into a Python function taking the values of its symbols in alphabetical order.
 
-            base = self[0]
-            exp = self[1]
+        The function computes the same exact result as `Eval` with straight-line arithmetic, each shared subtree being computed once.
+        The compiled function is cached on the node.
+        """
+        cache = self._cached()
+        if "compiled" in cache:
+            return cache["compiled"]
+
+        symbols = sorted(self.find_symbols())
+        names = {s: f"v{i}" for i, s in enumerate(symbols)}
+        namespace = {"rational": rational, "rational_pow": rational_pow}
+        lines = []
+
+        # Post-order traversal of the expression, visiting each shared subtree once
+        stack = [(self, False)]
+        while stack:
+            expr, visited = stack.pop()
+            if expr in names:
+                continue
+
+            name = f"t{len(names)}"
+            if expr.type == "N":
+                namespace[name] = expr[0]
+                names[expr] = name
+                continue
+            if not visited:
+                stack.append((expr, True))
+                stack.extend((op, False) for op in reversed(expr.operands))
+                continue
+
+            match expr.type:
+                case "A" | "M":
+                    # Long sums and products are accumulated over several statements
+                    operator = " + " if expr.type == "A" else " * "
+                    operands = [names[op] for op in expr.operands]
+                    value = operator.join(operands[:_COMPILE_CHUNK])
+                    for i in range(_COMPILE_CHUNK, len(operands), _COMPILE_CHUNK):
+                        lines.append(f"    {name} = {value}")
+                        value = operator.join([name, *operands[i : i + _COMPILE_CHUNK]])
+                case "P":
+                    base, exponent = expr.operands
+                    if (
+                        exponent.type == "N"
+                        and type(exponent[0]) is int
+                        and exponent[0] >= 0
+                    ):
+                        value = f"{names[base]} ** {exponent[0]}"
+                    elif exponent.type == "N":
+                        value = f"rational_pow({names[base]}, {names[exponent]})"
+                    else:
+                        value = (
+                            f"rational_pow({names[base]}, rational({names[exponent]}))"
+                        )
 
-            return mul(
-                exp,
-                pow(base, add(exp, -1)),
-                base.simple_derive(sym),
-            )
+            lines.append(f"    {name} = {value}")
+            names[expr] = name
+
+        arguments = ", ".join(names[s] for s in symbols)
+        body = "\n".join(lines) + f"\n    return rational({names[self]})"
+        # The code is generated from the expression alone, never from user input
+        exec(  # noqa: S102
+            compile(f"def evaluate({arguments}):\n{body}\n", "<expression>", "exec"),
+            namespace,
+        )
 
-        def derive_mul(self):
-            result = []
-            for i, item in enumerate(self.operands):
-                other = self.operands[:i] + self.operands[i + 1 :]
-                result += [mul(item.simple_derive(sym), *other)]
+        cache["compiled"] = namespace["evaluate"]
+        return cache["compiled"]
 
-            return add(*result)
+    def eval_batch(self, *columns, dtype=object):
+        """
+        Evaluates the expression at many points at once.
 
+        Each column holds the values of one symbol, in alphabetical order, at every point.
+        With the `object` dtype the results are the exact rationals of `Eval`, computed by the compiled evaluator.
+        With `float` (float64) and NumPy available, the tree is evaluated once over whole arrays with vectorised operations.
+        Results are NumPy arrays when NumPy is available, lists otherwise.
+        """
+        symbols = sorted(self.find_symbols())
+        if len(columns) != len(symbols):
+            raise Exception(
+                f"Expected {len(symbols)} columns of values, but got {len(columns)}."
+            )
+
+        if numpy is None or numpy.dtype(dtype).kind == "O":
+            evaluate = self.compile()
+            values = (
+                [evaluate(*point) for point in zip(*columns)]
+                if columns
+                else [evaluate()]
+            )
+            if numpy is not None:
+                return numpy.array(values, dtype=object)
+            return values if dtype is object else [_float(value) for value in values]
+
+        values = {s: _float_array(c, dtype) for s, c in zip(symbols, columns)}
+
+        # Post-order traversal of the expression, visiting each shared subtree once
+        stack = [(self, False)]
+        while stack:
+            expr, visited = stack.pop()
+            if expr in values:
+                continue
+            if expr.type == "N":
+                values[expr] = _float(expr[0])
+                continue
+            if not visited:
+                stack.append((expr, True))
+                stack.extend((op, False) for op in reversed(expr.operands))
+                continue
+
+            operands = [values[op] for op in expr.operands]
+            match expr.type:
+                case "A":
+                    values[expr] = sum(operands[1:], operands[0])
+                case "M":
+                    values[expr] = prod(operands[1:], start=operands[0])
+                case "P":
+                    values[expr] = numpy.power(*operands)
+
+        size = len(columns[0]) if columns else 1
+        return numpy.broadcast_to(values[self], (size,)).astype(dtype)
+
+    def _univariate(self, sym):
+        """Checks if the expression is an expanded polynomial in the single symbol `sym`."""
+        return (
+            self._expanded
+            and self._degree >= 0
+            and self._symbols == sym._symbols != _OTHER_SYMBOLS
+        )
+
+    @_memoized
+    def simple_derive(self, sym):
+        """Calculates the derivative of the expression with respect to the given symbol."""
         if sym.type != "S":
             raise Exception("Second argument must be a symbol")
 
-        derive_table = {
-            "P": derive_pow,
-            "M": derive_mul,
-            "A": lambda node: add(*[n.simple_derive(sym) for n in node]),
-            "S": lambda node: 0 if node != sym else 1,
-            "N": lambda _: 0,
-        }
+        if (
+            self.type == "A"
+            and self._symbols & sym._symbols
+            and not self._univariate(sym)
+        ):
+            derivatives = PARALLEL.map(self, "simple_derive", sym)
+            if derivatives is not None:
+                return add(*derivatives)
+
+        derivatives = {}
+
+        stack = [(self, False)]
+        while stack:
+            expr, visited = stack.pop()
+            if expr in derivatives:
+                continue
+            if expr.type == "N" or not expr._symbols & sym._symbols:
+                derivatives[expr] = num(0)
+                continue
+            if expr.type == "S":
+                derivatives[expr] = num(1) if expr is sym else num(0)
+                continue
+            # Dense polynomials are differentiated over their coefficient lists, with
+            # the same guard as `Polynomial.__mul__`, sparse ones term by term
+            if (
+                expr.type == "A"
+                and expr._univariate(sym)
+                and 2 * len(expr.operands) >= expr._degree
+            ):
+                coefficients = _dense_coefficients(expr, sym)
+                derivatives[expr] = _from_dense(
+                    sym, [k * c for k, c in enumerate(coefficients)][1:]
+                )
+                continue
+            if expr.type == "P" and expr[1].type != "N":
+                raise Exception("Non-rational exponent in expression")
+            if not visited:
+                stack.append((expr, True))
+                stack.extend((operand, False) for operand in expr.operands)
+                continue
+
+            match expr.type:
+                case "A":
+                    derivatives[expr] = add(
+                        *[derivatives[operand] for operand in expr.operands]
+                    )
+
+                case "M":
+                    result = []
+                    for i, item in enumerate(expr.operands):
+                        derivative = derivatives[item]
+                        if derivative == 0:
+                            continue
+
+                        other = expr.operands[:i] + expr.operands[i + 1 :]
+                        if derivative.type == "N":
+                            other = (
+                                other[0]
+                                if len(other) == 1
+                                else Expression._make("M", *other)
+                            )
+                            result += [scale(other, derivative[0])]
+                        else:
+                            result += [mul(derivative, *other)]
+
+                    derivatives[expr] = add(*result)
+
+                case "P":
+                    base, exp = expr.operands
+                    derivative = derivatives[base]
+
+                    if derivative.type == "N":
+                        derivatives[expr] = scale(
+                            pow(base, exp[0] - 1), exp[0] * derivative[0]
+                        )
+                    else:
+                        derivatives[expr] = mul(exp, pow(base, exp[0] - 1), derivative)
+
+        return derivatives[self]
 
-        return derive_table[self.type](self)
+    @_memoized
+    def gradient(self):
+        """
+        Calculates the derivatives of the expression with respect to each of its symbols,
+        in alphabetical order, with one traversal shared by all of them.
+        """
+        symbols = sorted(self.find_symbols())
+        derivatives = _partial_derivatives([self], symbols)[0]
+        return tuple(derivatives.get(symbol, num(0)) for symbol in symbols)
 
     def derive_polynomial(self, sym):
         """Calculates the derivative of a univariate polynomial expression with respect to the given symbol."""
         if sym.type != "S":
             raise Exception("Second argument must be a symbol")
 
-        expr = self.expand()
+        terms = len(self.operands) if self.type == "A" else 1
+        if self._univariate(sym):
+            if 2 * terms < self._degree:
+                return self.simple_derive(sym)
+            coefficients = _dense_coefficients(self, sym)
+            return _from_dense(sym, [k * c for k, c in enumerate(coefficients)][1:])
+
+        polynomial = Polynomial.from_expression(self)
+        dense = polynomial.dense() if polynomial.packed else None
+        if (
+            dense is not None
+            and chr(ord("a") + dense[0]) == sym[0]
+            and 2 * len(polynomial.terms) >= len(dense[1])
+        ):
+            return _from_dense(sym, [k * c for k, c in enumerate(dense[1])][1:])
+
+        expr = polynomial.to_expression()
         symbols = sorted(expr.find_symbols())
         if len(symbols) == 1 and symbols[0] == sym:
             return expr.simple_derive(sym)
         else:
             raise Exception("Expression is not a univariate polynomial")
+
+    @_memoized
+    def series(self, sym, order):
+        """
+        Expands the expression as a power series in `sym`, keeping the terms up to degree `order`.
+
+        The series of every subtree is a list of `order + 1` expanded coefficients, and the
+        terms above `order` are discarded by every intermediate product, so the work depends
+        on the requested order instead of the full degree of the expression.
+        Powers to a negative or fractional exponent use the binomial series,
+        which needs a non-zero constant term in the base.
+        """
+        if sym.type != "S":
+            raise Exception("Second argument must be a symbol")
+
+        zero = num(0)
+        series = {}
+
+        stack = [(self, False)]
+        while stack:
+            expr, visited = stack.pop()
+            if expr in series:
+                continue
+            if expr is sym:
+                series[expr] = [zero, num(1)][: order + 1] + [zero] * (order - 1)
+                continue
+            # Symbols other than `sym` may share its bit in the mask
+            if expr.type in ("N", "S") or not expr._symbols & sym._symbols:
+                series[expr] = [expr] + [zero] * order
+                continue
+            if expr.type == "P" and expr[1].type != "N":
+                raise Exception("Non-rational exponent in expression")
+            if not visited:
+                stack.append((expr, True))
+                stack.extend((operand, False) for operand in expr.operands)
+                continue
+
+            match expr.type:
+                case "A":
+                    series[expr] = [
+                        add(*coefficients).expand()
+                        for coefficients in zip(
+                            *(series[operand] for operand in expr.operands)
+                        )
+                    ]
+                case "M":
+                    result = series[expr[0]]
+                    for operand in expr[1:]:
+                        result = _series_mul(result, series[operand], order)
+                    series[expr] = result
+                case "P":
+                    series[expr] = _series_pow(series[expr[0]], expr[1][0], order)
+
+        return add(
+            *(mul(c, pow(sym, k)) for k, c in enumerate(series[self]) if c != 0)
+        ).expand()
+
+    def coefficients(self, sym):
+        """
+        Returns the index of the expanded expression by powers of `sym`: a dictionary
+        mapping each rational exponent to the sum of the factors multiplying `sym` to it.
+
+        The index is built with one pass over the terms on the first query for `sym`,
+        and cached on the node with the largest exponent, so that later queries are
+        dictionary lookups.
+        """
+        if sym.type != "S":
+            raise Exception("Second argument must be a symbol")
+
+        indexes = self._cached().setdefault("coefficients", {})
+        if sym in indexes:
+            return indexes[sym]
+
+        expanded = self.expand()
+        terms = {}
+        for term in expanded.operands if expanded.type == "A" else (expanded,):
+            degree = 0
+            rest = []
+            for factor in term.operands if term.type == "M" else (term,):
+                if factor is sym:
+                    degree = 1
+                elif factor.type == "P" and factor[0] is sym and factor[1].type == "N":
+                    degree = factor[1][0]
+                elif factor._symbols & sym._symbols and sym in factor.find_symbols():
+                    raise Exception(f"Expression is not a sum of powers of {sym[0]}")
+                else:
+                    rest.append(factor)
+            terms.setdefault(degree, []).append(mul(*rest))
+
+        index = {}
+        for degree, coefficients in terms.items():
+            coefficient = add(*coefficients)
+            if coefficient != 0:
+                index[degree] = coefficient
+
+        indexes[sym] = index
+        self._cache.setdefault("degrees", {})[sym] = max(index, default=0)
+        return index
+
+    def coefficient(self, sym, degree):
+        """Returns the coefficient of `sym^degree` in the expanded expression."""
+        return self.coefficients(sym).get(degree, num(0))
+
+    def degree(self, sym):
+        """Returns the largest exponent of `sym` in the expanded expression, 0 if it is constant."""
+        self.coefficients(sym)
+        return self._cache["degrees"][sym]
+
+    def collect(self, sym):
+        """Rewrites the expanded expression as a sum of powers of `sym`, each with its coefficient."""
+        return add(
+            *(
+                mul(coefficient, pow(sym, degree))
+                for degree, coefficient in self.coefficients(sym).items()
+            )
+        )
+
+
+def jacobian(*exprs):
+    """
+    Calculates the derivatives of each expression with respect to every symbol
+    of the expressions, in alphabetical order, returning one row per expression.
+    Subtrees shared between the expressions are derived once.
+    """
+    symbols = sorted(set().union(*(expr.find_symbols() for expr in exprs)))
+    rows = _partial_derivatives(exprs, symbols)
+    return [[row.get(symbol, num(0)) for symbol in symbols] for row in rows]
+
+
+def _partial_derivatives(roots, symbols):
+    """
+    Calculates the derivatives of the expressions in `roots` with respect to each of
+    `symbols` in a single traversal, returning for each root a dictionary from symbol to
+    derivative in which zero derivatives are left out.
+
+    Every subtree keeps only the derivatives of the symbols it contains,
+    so subtrees without a symbol are skipped for it, and shared subtrees are derived once.
+    """
+    wanted = set(symbols)
+    mask = 0
+    for symbol in symbols:
+        mask |= symbol._symbols
+
+    derivatives = {}
+
+    stack = [(root, False) for root in reversed(roots)]
+    while stack:
+        expr, visited = stack.pop()
+        if expr in derivatives:
+            continue
+        if expr.type == "N" or not expr._symbols & mask:
+            derivatives[expr] = {}
+            continue
+        if expr.type == "S":
+            derivatives[expr] = {expr: num(1)} if expr in wanted else {}
+            continue
+        if expr.type == "P" and expr[1].type != "N":
+            raise Exception("Non-rational exponent in expression")
+        if not visited:
+            stack.append((expr, True))
+            stack.extend((operand, False) for operand in expr.operands)
+            continue
+
+        terms = {}
+        match expr.type:
+            case "A":
+                for operand in expr.operands:
+                    for symbol, derivative in derivatives[operand].items():
+                        terms.setdefault(symbol, []).append(derivative)
+
+            case "M":
+                for i, item in enumerate(expr.operands):
+                    if not derivatives[item]:
+                        continue
+
+                    other = expr.operands[:i] + expr.operands[i + 1 :]
+                    product = (
+                        other[0] if len(other) == 1 else Expression._make("M", *other)
+                    )
+                    for symbol, derivative in derivatives[item].items():
+                        if derivative.type == "N":
+                            term = scale(product, derivative[0])
+                        else:
+                            term = mul(derivative, *other)
+                        terms.setdefault(symbol, []).append(term)
+
+            case "P":
+                base, exp = expr.operands
+                power = pow(base, exp[0] - 1)
+                for symbol, derivative in derivatives[base].items():
+                    if derivative.type == "N":
+                        term = scale(power, exp[0] * derivative[0])
+                    else:
+                        term = mul(exp, power, derivative)
+                    terms[symbol] = [term]
+
+        result = {}
+        for symbol, parts in terms.items():
+            derivative = add(*parts)
+            if derivative != 0:
+                result[symbol] = derivative
+        derivatives[expr] = result
+
+    return [derivatives[root] for root in roots]
+
+
+def _series_mul(a, b, order):
+    """Multiplies two truncated power series, discarding the terms above degree `order`."""
+    terms = [[] for _ in range(order + 1)]
+    for i, x in enumerate(a):
+        if x != 0:
+            for j in range(order + 1 - i):
+                if b[j] != 0:
+                    terms[i + j].append(mul(x, b[j]))
+    return [add(*products).expand() if products else num(0) for products in terms]
+
+
+def _series_pow(a, exponent, order):
+    """
+    Raises a truncated power series to a rational power.
+
+    With a numeric constant term, or a non-zero one and an exponent that is not a
+    positive integer, the coefficients of the binomial series of g = f^r follow from
+    g' f = r f' g as g_n = sum(((r + 1) k - n) f_k g_(n-k)) / (n f_0), for k from 1 to n.
+    Otherwise the power is computed by repeated squaring, which keeps the coefficients
+    polynomial when the constant term depends on other symbols.
+    """
+    positive = type(exponent) is int and exponent > 0
+    if a[0] == 0 or (positive and a[0].type != "N"):
+        if not positive:
+            raise Exception(
+                "Series of a power with a negative or fractional exponent "
+                + "needs a non-zero constant term"
+            )
+
+        result = None
+        square = a
+        while True:
+            if exponent & 1:
+                result = (
+                    square if result is None else _series_mul(result, square, order)
+                )
+            exponent >>= 1
+            if not exponent:
+                return result
+            square = _series_mul(square, square, order)
+
+    inverse = pow(a[0], -1)
+    result = [pow(a[0], exponent).expand()]
+    for n in range(1, order + 1):
+        terms = [
+            mul((exponent + 1) * k - n, a[k], result[n - k])
+            for k in range(1, n + 1)
+            if a[k] != 0
+        ]
+        result.append(
+            mul(Fraction(1, n), inverse, add(*terms)).expand() if terms else num(0)
+        )
+    return result
+
+
+# Monomials made only of the 26 single-letter symbols are packed into one int,
+# with `_FIELD` bits holding the exponent of each letter (Kronecker substitution).
+# The top bit of every field is a guard, set only when a product overflows the field.
+_FIELD = 16
+_FIELD_MASK = (1 << _FIELD) - 1
+_FIELD_LIMIT = 1 << (_FIELD - 1)
+_GUARDS = sum(_FIELD_LIMIT << (_FIELD * i) for i in range(26))
+
+
+def _packed_symbol(expr, exponent=1):
+    """Returns the packed monomial `expr^exponent`, or `None` if it cannot be packed."""
+    s = expr[0]
+    if (
+        len(s) == 1
+        and "a" <= s <= "z"
+        and type(exponent) is int
+        and 0 < exponent < _FIELD_LIMIT
+    ):
+        return exponent << (_FIELD * (ord(s) - ord("a")))
+    return None
+
+
+def _unpack(monomial):
+    """Converts a packed monomial to a tuple of `(base, exponent)` pairs sorted by base."""
+    pairs = []
+    index = 0
+    while monomial:
+        exponent = monomial & _FIELD_MASK
+        if exponent:
+            pairs.append((sym(chr(ord("a") + index)), exponent))
+        monomial >>= _FIELD
+        index += 1
+    return tuple(pairs)
+
+
+def _packed_degrees(monomials):
+    """Returns the largest exponent of each letter among packed monomials."""
+    degrees = [0] * 26
+    for monomial in monomials:
+        index = 0
+        while monomial:
+            exponent = monomial & _FIELD_MASK
+            if exponent > degrees[index]:
+                degrees[index] = exponent
+            monomial >>= _FIELD
+            index += 1
+    return degrees
+
+
+# Dense univariate products use Karatsuba's algorithm once both factors have this many
+# coefficients.
+_KARATSUBA_THRESHOLD = 32
+
+# Univariate factors are multiplied as dense coefficient lists when both have at least
+# this many terms and at least half of their coefficients are non-zero.
+_DENSE_MIN_TERMS = 16
+
+
+def _dense_add(a, b):
+    """Adds two dense coefficient lists."""
+    if len(a) < len(b):
+        a, b = b, a
+    return [x + y for x, y in zip(a, b)] + a[len(b) :]
+
+
+def _dense_mul(a, b):
+    """Multiplies two dense coefficient lists, using Karatsuba's algorithm above `_KARATSUBA_THRESHOLD`."""
+    if len(a) < len(b):
+        a, b = b, a
+
+    if len(b) < _KARATSUBA_THRESHOLD:
+        result = [0] * (len(a) + len(b) - 1)
+        for i, x in enumerate(a):
+            if x:
+                for j, y in enumerate(b):
+                    result[i + j] += x * y
+        return result
+
+    half = len(a) // 2
+    a0, a1 = a[:half], a[half:]
+
+    if len(b) <= half:
+        low, high = _dense_mul(a0, b), _dense_mul(a1, b)
+        return _dense_add(low, [0] * half + high)
+
+    b0, b1 = b[:half], b[half:]
+    z0 = _dense_mul(a0, b0)
+    z2 = _dense_mul(a1, b1)
+    z1 = _dense_mul(_dense_add(a0, a1), _dense_add(b0, b1))
+
+    result = [0] * (len(a) + len(b) - 1)
+    for i, c in enumerate(z0):
+        result[i] += c
+        result[i + half] -= c
+    for i, c in enumerate(z2):
+        result[i + 2 * half] += c
+        result[i + half] -= c
+    for i, c in enumerate(z1):
+        result[i + half] += c
+    return result
+
+
+def _sparse_coefficients(expr, symbol):
+    """Returns the nonzero coefficients of an expanded polynomial in `symbol` alone by degree, otherwise `None`."""
+    coefficients = {}
+    for term in expr.operands if expr.type == "A" else (expr,):
+        c = 1
+        if term.type == "M" and len(term.operands) == 2 and term[0].type == "N":
+            c, term = term[0][0], term[1]
+
+        if term.type == "N":
+            c, degree = term[0], 0
+        elif term is symbol:
+            degree = 1
+        elif (
+            term.type == "P"
+            and term[0] is symbol
+            and type(term[1][0]) is int
+            and term[1][0] > 0
+        ):
+            degree = term[1][0]
+        else:
+            return None
+
+        coefficients[degree] = c
+
+    return coefficients
+
+
+def _dense_coefficients(expr, symbol):
+    """Returns the coefficients of an expanded polynomial in `symbol` alone as a dense list, otherwise `None`."""
+    coefficients = _sparse_coefficients(expr, symbol)
+    if coefficients is None:
+        return None
+
+    dense = [0] * (max(coefficients) + 1)
+    for degree, c in coefficients.items():
+        dense[degree] = c
+    return dense
+
+
+def _from_dense(symbol, coefficients):
+    """Builds the simplified expression of a polynomial in `symbol` from its dense coefficient list."""
+    terms = []
+    for degree, c in enumerate(coefficients):
+        if c == 0:
+            continue
+
+        c = rational(c)
+        if degree == 0:
+            terms.append(num(c))
+            continue
+
+        power = symbol if degree == 1 else Expression._make("P", symbol, num(degree))
+        terms.append(power if c == 1 else Expression._make("M", num(c), power))
+
+    if not terms:
+        return num(0)
+    if len(terms) == 1:
+        return terms[0]
+    return Expression._make("A", *_sorted(terms))
+
+
+def _exponent_add(a, b):
+    """Adds two exponents, each either a rational number or a non-numeric expression."""
+    if type(a) is not Expression and type(b) is not Expression:
+        return rational(a + b)
+
+    result = add(a, b)
+    return result[0] if result.type == "N" else result
+
+
+def _monomial_key(item):
+    """Sort key of a `(base, exponent)` pair inside a monomial."""
+    return item[0]._key
+
+
+def _monomial_mul(m1, m2):
+    """
+    Multiplies two monomials, each a tuple of `(base, exponent)` pairs sorted by base.
+
+    Returns the product, the rational factor produced by numeric bases whose exponent became a number,
+    and whether a sum became a base with a positive integer exponent, which must be expanded again.
+    """
+    if not m1:
+        return m2, 1, False
+    if not m2:
+        return m1, 1, False
+
+    exponents = dict(m1)
+    factor = 1
+    sums = False
+
+    for base, exponent in m2:
+        if base in exponents:
+            exponent = _exponent_add(exponents[base], exponent)
+
+            if type(exponent) is not Expression and base.type == "N":
+                factor *= rational_pow(base[0], exponent)
+                del exponents[base]
+                continue
+            if exponent == 0:
+                del exponents[base]
+                continue
+            if base.type == "A" and type(exponent) is int and exponent > 0:
+                sums = True
+
+        exponents[base] = exponent
+
+    return tuple(_sorted(exponents.items(), _monomial_key)), factor, sums
+
+
+class Polynomial:
+    """
+    Sparse polynomial used by `Expression.expand`.
+
+    It maps monomials to rational coefficients. A monomial is a tuple of `(base, exponent)` pairs sorted by base,
+    where a base is any expression that cannot be expanded further and an exponent is either a rational number
+    or a non-numeric expression, matching how products of powers are merged by `Expression`.
+    When every monomial is a product of single-letter symbols with small non-negative integer exponents,
+    the polynomial is packed: monomials are ints, multiplied by integer addition.
+    A packed polynomial can also have its coefficients modulo a prime `modulus`.
+    """
+
+    __slots__ = ("modulus", "packed", "terms")
+
+    def __init__(self, terms, packed=False, modulus=None):
+        """Initializes the polynomial from a dictionary mapping monomials to non-zero coefficients."""
+        self.terms = terms
+        self.packed = packed
+        self.modulus = modulus
+
+    @classmethod
+    def constant(cls, c, modulus=None):
+        """Creates a constant polynomial."""
+        if modulus is not None:
+            c = c.numerator * builtins.pow(c.denominator, -1, modulus) % modulus
+        return cls({0: c} if c != 0 else {}, True, modulus)
+
+    @classmethod
+    def symbol(cls, expr, exponent=1, modulus=None):
+        """Creates the polynomial `expr^exponent` made of a single base."""
+        monomial = _packed_symbol(expr, exponent) if expr.type == "S" else None
+        if monomial is not None:
+            return cls({monomial: 1}, True, modulus)
+        return cls({((expr, exponent),): 1})
+
+    def _nonzero(self, terms):
+        """Creates a packed polynomial with the same modulus from the non-zero terms."""
+        modulus = self.modulus
+        if modulus is None:
+            return Polynomial({m: c for m, c in terms.items() if c != 0}, True)
+        return Polynomial(
+            {m: c % modulus for m, c in terms.items() if c % modulus}, True, modulus
+        )
+
+    @classmethod
+    def from_expression(cls, expr, modulus=None):
+        """
+        Builds the polynomial obtained by expanding the given expression.
+        With a `modulus`, the expression must be a polynomial in single-letter symbols,
+        and an `OverflowError` is raised when an exponent does not fit a packed
+        monomial.
+        """
+        # Number of operand slots still to read each subtree's polynomial, so it can be
+        # released after its last use
+        uses = {}
+        stack = [expr]
+        while stack:
+            node = stack.pop()
+            if node.type in ("N", "S"):
+                continue
+            for operand in node.operands:
+                uses[operand] = uses.get(operand, 0) + 1
+                if uses[operand] == 1:
+                    stack.append(operand)
+
+        polynomials = {}
+
+        def take(node):
+            uses[node] -= 1
+            return polynomials[node] if uses[node] else polynomials.pop(node)
+
+        stack = [(expr, False)]
+        while stack:
+            node, visited = stack.pop()
+            if node in polynomials:
+                continue
+
+            match node.type:
+                case "N":
+                    polynomials[node] = cls.constant(node[0], modulus)
+                    continue
+                case "S":
+                    polynomials[node] = cls.symbol(node, modulus=modulus)
+                    continue
+
+            if not visited:
+                stack.append((node, True))
+                stack.extend((operand, False) for operand in node.operands)
+                continue
+
+            match node.type:
+                case "A":
+                    result = cls.constant(0, modulus)
+                    for operand in node.operands:
+                        result += take(operand)
+                case "M":
+                    result = take(node[0])
+                    for operand in node[1:]:
+                        result *= take(operand)
+                case "P":
+                    base, exponent = node.operands
+                    polynomial = take(base)
+                    exponent_polynomial = take(exponent)
+
+                    if exponent.type == "N":
+                        numerator, denominator = exponent[0].as_integer_ratio()
+
+                        if numerator > 0 and denominator == 1:
+                            result = polynomial**numerator
+                        else:
+                            power = polynomial ** abs(numerator)
+                            sign = 1 if numerator > 0 else -1
+                            result = cls.from_expanded(
+                                pow(power.to_expression(), Fraction(sign, denominator))
+                            )
+                    else:
+                        if not base._expanded:
+                            base = polynomial.to_expression()
+                        if not exponent._expanded:
+                            exponent = exponent_polynomial.to_expression()
+                        result = cls.from_expanded(pow(base, exponent))
+
+            polynomials[node] = result
+
+        return polynomials[expr]
+
+    @classmethod
+    def from_expanded(cls, expr):
+        """Builds the polynomial of an expression that is already expanded, without expanding it again."""
+        match expr.type:
+            case "N":
+                return cls.constant(expr[0])
+            case "S":
+                return cls.symbol(expr)
+            case "A":
+                result = cls.constant(0)
+                for operand in expr.operands:
+                    result += cls.from_expanded(operand)
+                return result
+            case "M":
+                result = cls.from_expanded(expr[0])
+                for operand in expr[1:]:
+                    result *= cls.from_expanded(operand)
+                return result
+            case "P":
+                base, exponent = expr.operands
+
+                if exponent.type == "N":
+                    if (
+                        base.type == "A"
+                        and type(exponent[0]) is int
+                        and exponent[0] > 0
+                    ):
+                        return cls.from_expanded(base) ** exponent[0]
+                    return cls.symbol(base, exponent[0])
+
+                return cls.symbol(base, exponent)
+
+    def unpacked(self):
+        """Returns the polynomial with its monomials as tuples of `(base, exponent)` pairs."""
+        if not self.packed:
+            return self
+        return Polynomial({_unpack(m): c for m, c in self.terms.items()})
+
+    def __add__(self, other):
+        """Adds two polynomials."""
+        if self.packed != other.packed:
+            return self.unpacked() + other.unpacked()
+
+        terms = self.terms.copy()
+        for monomial, coefficient in other.terms.items():
+            coefficient += terms.get(monomial, 0)
+            if self.modulus is not None:
+                coefficient %= self.modulus
+            if coefficient != 0:
+                terms[monomial] = coefficient
+            else:
+                terms.pop(monomial, None)
+        return Polynomial(terms, self.packed, self.modulus)
+
+    def dense(self):
+        """
+        Returns `(index, coefficients)` when the packed polynomial is univariate in the letter with that index,
+        where `coefficients` is the dense list of its coefficients, otherwise `None`.
+        """
+        mask = 0
+        for monomial in self.terms:
+            mask |= monomial
+        if not mask:
+            return None
+
+        index = (mask.bit_length() - 1) // _FIELD
+        shift = _FIELD * index
+        if mask >> shift << shift != mask:
+            return None
+
+        coefficients = [0] * ((max(self.terms) >> shift) + 1)
+        for monomial, c in self.terms.items():
+            coefficients[monomial >> shift] = c
+        return index, coefficients
+
+    def from_dense(self, index, coefficients):
+        """
+        Creates a packed polynomial with the same modulus
+        in the letter with the given index from its dense coefficient list.
+        """
+        shift = _FIELD * index
+        return self._nonzero({k << shift: c for k, c in enumerate(coefficients)})
+
+    def __mul__(self, other):
+        """
+        Multiplies two polynomials.
+        Large, mostly dense univariate polynomials in the same symbol are multiplied as dense coefficient lists.
+        """
+        if self.packed and other.packed:
+            if (
+                len(self.terms) >= _DENSE_MIN_TERMS
+                and len(other.terms) >= _DENSE_MIN_TERMS
+            ):
+                a, b = self.dense(), other.dense()
+                if (
+                    a is not None
+                    and b is not None
+                    and a[0] == b[0]
+                    and 2 * len(self.terms) >= len(a[1])
+                    and 2 * len(other.terms) >= len(b[1])
+                    and len(a[1]) + len(b[1]) - 2 < _FIELD_LIMIT
+                ):
+                    return self.from_dense(a[0], _dense_mul(a[1], b[1]))
+
+            terms = {}
+            for m1, c1 in self.terms.items():
+                for m2, c2 in other.terms.items():
+                    monomial = m1 + m2
+                    if monomial & _GUARDS:
+                        if self.modulus is not None:
+                            raise OverflowError(
+                                "Exponent too large for a packed monomial"
+                            )
+                        return self.unpacked() * other.unpacked()
+                    terms[monomial] = terms.get(monomial, 0) + c1 * c2
+            return self._nonzero(terms)
+
+        if self.packed or other.packed:
+            return self.unpacked() * other.unpacked()
+
+        terms = {}
+        pending = []
+
+        for m1, c1 in self.terms.items():
+            for m2, c2 in other.terms.items():
+                monomial, factor, sums = _monomial_mul(m1, m2)
+                if sums:
+                    pending.append((monomial, c1 * c2 * factor))
+                else:
+                    terms[monomial] = terms.get(monomial, 0) + c1 * c2 * factor
+
+        result = Polynomial({m: c for m, c in terms.items() if c != 0})
+
+        for monomial, coefficient in pending:
+            product = Polynomial.constant(coefficient)
+            rest = []
+            for base, exponent in monomial:
+                if base.type == "A" and type(exponent) is int and exponent > 0:
+                    product *= Polynomial.from_expanded(base) ** exponent
+                else:
+                    rest.append((base, exponent))
+            result += product * Polynomial({tuple(rest): 1})
+
+        return result
+
+    def __pow__(self, n):
+        """
+        Raises the polynomial to a non-negative integer power.
+
+        Packed polynomials whose power has few colliding terms are expanded with the multinomial theorem,
+        so the work is proportional to the size of the result. Otherwise the power is computed by repeated squaring.
+        """
+        if n == 0:
+            return Polynomial.constant(1, self.modulus)
+        if n == 1 or not self.terms:
+            return self
+
+        if self.packed:
+            degrees = _packed_degrees(self.terms)
+            if max(degrees) * n < _FIELD_LIMIT:
+                compositions = comb(n + len(self.terms) - 1, n)
+                bound = prod(d * n + 1 for d in degrees if d)
+                if compositions <= 4 * bound:
+                    return self._multinomial(n)
+
+        result = None
+        square = self
+        while True:
+            if n & 1:
+                result = square if result is None else result * square
+            n >>= 1
+            if not n:
+                return result
+            square = square * square
+
+    def _multinomial(self, n):
+        """Raises a packed polynomial to the power `n` by enumerating the terms of the multinomial expansion."""
+        modulus = self.modulus
+        items = list(self.terms.items())
+        last = len(items) - 1
+        coefficient_powers = []
+        for _, c in items:
+            powers = [1]
+            for _ in range(n):
+                power = powers[-1] * c
+                powers.append(power if modulus is None else power % modulus)
+            coefficient_powers.append(powers)
+
+        terms = {}
+        stack = [(0, n, 1, 0)]
+        while stack:
+            i, remaining, coefficient, monomial = stack.pop()
+            if i == last:
+                monomial += items[i][0] * remaining
+                coefficient *= coefficient_powers[i][remaining]
+                terms[monomial] = terms.get(monomial, 0) + coefficient
+                continue
+
+            for k in range(remaining + 1):
+                c = coefficient * comb(remaining, k) * coefficient_powers[i][k]
+                stack.append(
+                    (
+                        i + 1,
+                        remaining - k,
+                        c if modulus is None else c % modulus,
+                        monomial + items[i][0] * k,
+                    )
+                )
+
+        return self._nonzero(terms)
+
+    def to_expression(self):
+        """
+        Converts the polynomial back to a simplified `Expression`.
+
+        A sum or product raised to a rational exponent n/d is written as the expansion of
+        its power to |n|, raised to ±1/d unless n/d is a positive integer,
+        the same form `from_expression` gives to such a power.
+        """
+        terms = []
+        # Whether a power was rewritten, which may merge factors or terms
+        rewritten = False
+
+        for monomial, coefficient in self.unpacked().terms.items():
+            factors = []
+            for base, exponent in monomial:
+                # A product left as a base, by powers of it adding up to 1, is split
+                # into its factors below
+                if exponent == 1 and base.type != "M":
+                    factors.append(base)
+                elif (
+                    base.type in ("A", "M")
+                    and type(exponent) is not Expression
+                    and (type(exponent) is int or abs(exponent.numerator) != 1)
+                ):
+                    power = Polynomial.from_expanded(base) ** abs(exponent.numerator)
+                    power = power.to_expression()
+                    if type(exponent) is int and exponent > 0:
+                        factors.append(power)
+                    else:
+                        sign = 1 if exponent > 0 else -1
+                        factors.append(pow(power, Fraction(sign, exponent.denominator)))
+                    rewritten = True
+                else:
+                    factors.append(pow(base, exponent))
+
+            factors = _sorted(factors)
+            coefficient = rational(coefficient)
+
+            if rewritten:
+                terms.append(mul(coefficient, *factors))
+            elif not factors:
+                terms.append(num(coefficient))
+            elif coefficient != 1:
+                terms.append(Expression._make("M", num(coefficient), *factors))
+            elif len(factors) == 1:
+                terms.append(factors[0])
+            else:
+                terms.append(Expression._make("M", *factors))
+
+        if rewritten:
+            return add(*terms)
+        if not terms:
+            return num(0)
+        if len(terms) == 1:
+            return terms[0]
+        return Expression._make("A", *_sorted(terms))
+
+
+# Moduli of `Expression.expand_modular`, the largest primes below 2^62 in decreasing
+# order, found as they are needed.
+_MODULAR_PRIMES = []
+
+# Bases for which the Miller-Rabin test is deterministic below 3.3 * 10^24.
+_MILLER_RABIN_BASES = (2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41)
+
+
+def _is_prime(n):
+    """Checks whether an odd number below 3.3 * 10^24 is prime by Miller-Rabin."""
+    d, s = n - 1, 0
+    while d % 2 == 0:
+        d, s = d // 2, s + 1
+
+    for a in _MILLER_RABIN_BASES:
+        x = builtins.pow(a, d, n)
+        if x in (1, n - 1):
+            continue
+        for _ in range(s - 1):
+            x = x * x % n
+            if x == n - 1:
+                break
+        else:
+            return False
+    return True
+
+
+def _modular_prime(i):
+    """Returns the `i`-th largest prime below 2^62."""
+    while len(_MODULAR_PRIMES) <= i:
+        n = _MODULAR_PRIMES[-1] - 2 if _MODULAR_PRIMES else (1 << 62) - 1
+        while not _is_prime(n):
+            n -= 2
+        _MODULAR_PRIMES.append(n)
+    return _MODULAR_PRIMES[i]
+
+
+def _coefficient_bounds(expr):
+    """
+    Bounds the coefficients of the expansion of a polynomial expression.
+
+    Returns the base-2 logarithm of a bound on the sum of the absolute values of the
+    coefficients, which is the value of the expression with every number replaced by its
+    absolute value and every symbol by 1, and a multiple of the denominator of every
+    coefficient.
+    """
+    bounds = {}
+
+    stack = [(expr, False)]
+    while stack:
+        node, visited = stack.pop()
+        if node in bounds:
+            continue
+
+        match node.type:
+            case "N":
+                numerator, denominator = node[0].as_integer_ratio()
+                bounds[node] = (
+                    log2(abs(numerator)) - log2(denominator) if numerator else -inf,
+                    denominator,
+                )
+                continue
+            case "S":
+                bounds[node] = 0, 1
+                continue
+
+        if not visited:
+            stack.append((node, True))
+            stack.extend((operand, False) for operand in node.operands)
+            continue
+
+        operands = [bounds[operand] for operand in node.operands]
+        match node.type:
+            case "A":
+                largest = max(height for height, _ in operands)
+                height = largest + log2(
+                    sum(2 ** (height - largest) for height, _ in operands)
+                )
+                bounds[node] = (
+                    height,
+                    lcm(*(denominator for _, denominator in operands)),
+                )
+            case "M":
+                bounds[node] = (
+                    sum(height for height, _ in operands),
+                    prod(d for _, d in operands),
+                )
+            case "P":
+                (height, denominator), exponent = operands[0], node[1][0]
+                bounds[node] = height * exponent, denominator**exponent
+
+    return bounds[expr]
+
+
+def _rational_reconstruction(c, modulus, bound):
+    """
+    Returns the fraction a/b congruent to `c` modulo `modulus` with |a| at most `bound`,
+    which is unique when its denominator is at most `modulus / (2 * bound)`.
+    """
+    r0, r1 = modulus, c
+    t0, t1 = 0, 1
+    while r1 > bound:
+        q = r0 // r1
+        r0, r1 = r1, r0 - q * r1
+        t0, t1 = t1, t0 - q * t1
+    return Fraction(r1, t1)
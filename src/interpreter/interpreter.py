@@ -1,7 +1,7 @@
 import inspect
 from operator import eq, ge, gt, le, lt
 
-from src.interpreter.expression import Expression, add, mul, num, pow, sym
+from src.interpreter.expression import Expression, add, mul, num, pow, scale, sym
 from src.interpreter.stdlib import STDLIB
 
 
@@ -60,12 +60,12 @@ def interpreter(program, fun_name="Main", args=[], trace=False):
                         raise Exception(f"ERROR in {fun_name}: Division by zero")
             case "UNARY_EXPRESSION":
                 if instr["value"] == "-":
-                    STACK.append(mul(STACK.pop(), -1))
+                    STACK.append(scale(STACK.pop(), -1))
             case "ADD_SUB_EXPRESSION":
                 if instr["value"] == "+":
                     STACK.append(add(STACK.pop(), STACK.pop()))
                 elif instr["value"] == "-":
-                    STACK.append(add(mul(STACK.pop(), -1), STACK.pop()))
+                    STACK.append(add(scale(STACK.pop(), -1), STACK.pop()))
 
             case "DECLARATION_INSTRUCTION":
                 GLOBAL_MEMORY[instr["value"]] = STACK.pop()
@@ -99,7 +99,7 @@ def interpreter(program, fun_name="Main", args=[], trace=False):
                     )
 
                 if count > 0:
-                    STACK.append(add(count, -1))
+                    STACK.append(num(count - 1))
                     IP = instr["jumps"]["loop"]
                 else:
                     IP = instr["jumps"]["next"]
@@ -128,12 +128,19 @@ def interpreter(program, fun_name="Main", args=[], trace=False):
                 elif name in STDLIB:
                     func = STDLIB[name]
 
-                    len_params = len(inspect.signature(func).parameters)
+                    parameters = inspect.signature(func).parameters.values()
+                    len_params = sum(p.kind is not p.VAR_POSITIONAL for p in parameters)
                     num_params = instr["value"]["parameters"]
 
-                    if (name == "Eval" and num_params < 2) or (
-                        name != "Eval" and len_params != num_params
-                    ):
+                    # Functions taking a variable number of values expect at least one
+                    # of them
+                    if any(p.kind is p.VAR_POSITIONAL for p in parameters):
+                        if num_params <= len_params:
+                            raise Exception(
+                                f"ERROR in {fun_name}: Called function {name} with incorrect number of parameters. "
+                                + f"Expected at least {len_params + 1}, but got {num_params}."
+                            )
+                    elif len_params != num_params:
                         raise Exception(
                             f"ERROR in {fun_name}: Called function {name} with incorrect number of parameters. "
                             + f"Expected {len_params}, but got {num_params}."
@@ -175,7 +182,10 @@ def interpreter(program, fun_name="Main", args=[], trace=False):
                 right = STACK.pop()
                 left = STACK.pop()
                 op = {"<=": le, "<": lt, "==": eq, ">": gt, ">=": ge}
-                STACK.append(op[instr["value"]](left, right))
+                if instr["value"] == "==" and type(left) is type(right) is Expression:
+                    STACK.append(left.equivalent(right))
+                else:
+                    STACK.append(op[instr["value"]](left, right))
 
             case _:
                 raise Exception(
@@ -0,0 +1,157 @@
+import mmap
+import os
+from fractions import Fraction
+
+from src.interpreter.expression import Expression
+
+# Header of every serialized expression, followed by the format version.
+MAGIC = b"LPX\x01"
+
+# Tag byte of each node type in the node table.
+_TAGS = {"N": 0, "S": 1, "A": 2, "M": 3, "P": 4}
+_TYPES = {tag: expr_type for expr_type, tag in _TAGS.items()}
+
+
+def _write_varint(out, n):
+    """Appends a non-negative integer to `out` as a little-endian base-128 varint."""
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(data, pos):
+    """Reads a varint from `data` at `pos`, returning the integer and the position after it."""
+    result = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def dumps(expr):
+    """
+    Serializes an expression to bytes.
+
+    The encoding is a table of the distinct subtrees in post-order, so every shared subtree is written once.
+    Each node is a tag byte followed by its content: numbers as a zigzag varint numerator and a varint denominator,
+    symbols as their UTF-8 name prefixed by its length, and sums, products and powers as their operand count
+    followed by the distance back in the table to each operand. The last node is the root.
+    """
+    index = {}
+    table = []
+
+    stack = [(expr, False)]
+    while stack:
+        node, visited = stack.pop()
+        if id(node) in index:
+            continue
+        if not visited and node.type not in ("N", "S"):
+            stack.append((node, True))
+            stack.extend((operand, False) for operand in reversed(node.operands))
+            continue
+
+        index[id(node)] = len(table)
+        table.append(node)
+
+    out = bytearray(MAGIC)
+    _write_varint(out, len(table))
+
+    for i, node in enumerate(table):
+        out.append(_TAGS[node.type])
+        match node.type:
+            case "N":
+                numerator, denominator = node[0].as_integer_ratio()
+                _write_varint(
+                    out, 2 * numerator if numerator >= 0 else -2 * numerator - 1
+                )
+                _write_varint(out, denominator)
+            case "S":
+                name = node[0].encode()
+                _write_varint(out, len(name))
+                out += name
+            case _:
+                _write_varint(out, len(node.operands))
+                for operand in node.operands:
+                    _write_varint(out, i - index[id(operand)])
+
+    return bytes(out)
+
+
+def loads(data):
+    """
+    Deserializes an expression from a bytes-like object produced by `dumps`, such as bytes or a memory map.
+    Nodes are rebuilt through the full constructor, and each one must come out unchanged,
+    so a corrupt or crafted input cannot produce a node that is not in simplified form.
+    """
+    with memoryview(data) as view:
+        if view[: len(MAGIC)] != MAGIC:
+            raise Exception("Invalid serialized expression")
+
+        try:
+            return _read_table(view)
+        except (IndexError, KeyError, ValueError, ZeroDivisionError):
+            raise Exception("Invalid serialized expression")
+
+
+def _read_table(data):
+    """Reads the node table following the header and returns its last node."""
+    count, pos = _read_varint(data, len(MAGIC))
+    table = []
+
+    for i in range(count):
+        expr_type = _TYPES[data[pos]]
+        pos += 1
+
+        match expr_type:
+            case "N":
+                numerator, pos = _read_varint(data, pos)
+                denominator, pos = _read_varint(data, pos)
+                numerator = (
+                    numerator >> 1 if numerator & 1 == 0 else -(numerator >> 1) - 1
+                )
+                operands = [Fraction(numerator, denominator)]
+            case "S":
+                length, pos = _read_varint(data, pos)
+                if pos + length > len(data):
+                    raise IndexError
+                operands = [str(data[pos : pos + length], "utf-8")]
+                pos += length
+            case _:
+                length, pos = _read_varint(data, pos)
+                operands = []
+                for _ in range(length):
+                    distance, pos = _read_varint(data, pos)
+                    if not 1 <= distance <= i:
+                        raise IndexError
+                    operands.append(table[i - distance])
+
+        node = Expression(expr_type, *operands)
+        if node.type != expr_type or len(node.operands) != len(operands):
+            raise ValueError
+        if expr_type in ("N", "S"):
+            if node[0] != operands[0]:
+                raise ValueError
+        elif any(a is not b for a, b in zip(node.operands, operands)):
+            raise ValueError
+        table.append(node)
+
+    return table[-1]
+
+
+def dump(expr, file):
+    """Writes the serialized expression to a binary file object."""
+    file.write(dumps(expr))
+
+
+def load(path):
+    """Reads a serialized expression from the file at `path`, mapping it in memory instead of reading it."""
+    with open(path, "rb") as file:
+        # An empty file cannot be mapped
+        if os.fstat(file.fileno()).st_size == 0:
+            raise Exception("Invalid serialized expression")
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            return loads(data)
@@ -1,4 +1,6 @@
-from src.interpreter.expression import num, sym
+import sys
+
+from src.interpreter.expression import Expression, jacobian, num, sym
 
 
 def stdlib_expand(expr):
@@ -6,9 +8,14 @@ def stdlib_expand(expr):
     return expr.expand()
 
 
+def stdlib_expand_modular(expr):
+    """Expands a mathematical expression, computing its coefficients modulo several primes."""
+    return expr.expand_modular()
+
+
 def stdlib_substitute(expr, match, subst):
     """Substitutes an expression `match` in the given expression `expr` with a new value `subst`."""
-    return expr.substitute(match, subst)
+    return expr.substitute_all({match: subst})
 
 
 def stdlib_eval(expr, *rat):
@@ -16,16 +23,70 @@ def stdlib_eval(expr, *rat):
     return expr.eval(*rat)
 
 
+def stdlib_eval_batch(expr, *rat):
+    """Evaluates the given expression at several points, each given as consecutive rational numbers, one per symbol."""
+    symbols = len(expr.find_symbols())
+
+    if any(i.type != "N" for i in rat):
+        raise Exception("Expected rational number")
+    if symbols == 0:
+        raise Exception(
+            "Expected an expression with symbols, as its points cannot be told apart."
+        )
+    if len(rat) % symbols != 0:
+        raise Exception(
+            f"Expected a multiple of {symbols} rational numbers, but got {len(rat)}."
+        )
+
+    values = [i[0] for i in rat]
+    columns = [values[i::symbols] for i in range(symbols)]
+    return [num(value) for value in expr.eval_batch(*columns)]
+
+
 def stdlib_simple_derive(expr, sym):
     """Computes the simple derivative of an expression with respect to a symbol."""
     return expr.simple_derive(sym)
 
 
+def stdlib_gradient(expr):
+    """Computes the derivatives of an expression with respect to each of its symbols, in alphabetical order."""
+    return list(expr.gradient())
+
+
+def stdlib_jacobian(*exprs):
+    """Computes the derivatives of each expression with respect to every symbol of the expressions."""
+    return jacobian(*exprs)
+
+
 def stdlib_derive_polynomial(poly, sym):
     """Derives a univariate polynomial with respect to a symbol."""
     return poly.derive_polynomial(sym)
 
 
+def stdlib_series(expr, sym, order):
+    """Expands an expression as a power series in a symbol, up to the given order."""
+    if order.type != "N" or type(order[0]) is not int or order[0] < 0:
+        raise Exception("Third argument must be a natural number")
+    return expr.series(sym, order[0])
+
+
+def stdlib_coefficient(expr, sym, degree):
+    """Returns the coefficient of a power of a symbol in the expanded expression."""
+    if degree.type != "N":
+        raise Exception("Third argument must be a rational number")
+    return expr.coefficient(sym, degree[0])
+
+
+def stdlib_degree(expr, sym):
+    """Returns the largest exponent of a symbol in the expanded expression."""
+    return num(expr.degree(sym))
+
+
+def stdlib_collect(expr, sym):
+    """Groups the terms of the expanded expression by powers of a symbol."""
+    return expr.collect(sym)
+
+
 def stdlib_input():
     """Reads input from the user and converts it to a number or symbol."""
     value = input()
@@ -38,17 +99,29 @@ def stdlib_input():
 
 
 def stdlib_print(expr):
-    """Prints the given expression to the console."""
-    print(expr)
+    """Prints the given expression to the console, writing it as it is formatted."""
+    if type(expr) is Expression:
+        expr.write(sys.stdout)
+        sys.stdout.write("\n")
+    else:
+        print(expr)
     return expr
 
 
 STDLIB = {
     "Expand": stdlib_expand,
+    "ExpandModular": stdlib_expand_modular,
     "Substitute": stdlib_substitute,
     "Eval": stdlib_eval,
+    "EvalBatch": stdlib_eval_batch,
     "SimpleDerive": stdlib_simple_derive,
     "DerivePolynomial": stdlib_derive_polynomial,
+    "Gradient": stdlib_gradient,
+    "Jacobian": stdlib_jacobian,
+    "Series": stdlib_series,
+    "Coefficient": stdlib_coefficient,
+    "Degree": stdlib_degree,
+    "Collect": stdlib_collect,
     "Input": stdlib_input,
     "Print": stdlib_print,
 }
@@ -11,8 +11,18 @@ from src.ast.threading import thread_program, thread_to_json
 from src.error.luppolo_error_listener import LuppoloErrorListener
 from src.grammar.LuppoloLexer import LuppoloLexer
 from src.grammar.LuppoloParser import LuppoloParser
-from src.interpreter.expression import num, sym
+from src.interpreter.expression import (
+    MEMO,
+    MEMO_SIZE,
+    PARALLEL,
+    configure_identity,
+    configure_memo,
+    configure_parallel,
+    num,
+    sym,
+)
 from src.interpreter.interpreter import interpreter
+from src.interpreter.stdlib import stdlib_print
 
 
 def compile_source(src: str, optimize_flag: bool = False, ast_flag: bool = False):
@@ -70,7 +80,15 @@ def compile_source(src: str, optimize_flag: bool = False, ast_flag: bool = False
     return ir
 
 
-def run_ir(ir: dict, args: list = [], trace_flag: bool = False):
+def run_ir(
+    ir: dict,
+    args: list = [],
+    trace_flag: bool = False,
+    memo_size: int = MEMO_SIZE,
+    identity_error: float = 0,
+    seed: int = 0,
+    workers: int = 1,
+):
     """
     Executes the given Intermediate Representation (IR) with the provided arguments.
 
@@ -80,6 +98,10 @@ def run_ir(ir: dict, args: list = [], trace_flag: bool = False):
       ir (dict): The Intermediate Representation to execute.
       args (list): A list of arguments to pass to the program.
       trace_flag (bool): If True, enables tracing of the stack interpreter during execution.
+      memo_size (int): The number of results of Expand, SimpleDerive and Substitute to cache, 0 disables the cache.
+      identity_error (float): The probability bound of `==` wrongly reporting two polynomials equal, 0 disables the test.
+      seed (int): The seed of the random points used by the identity test.
+      workers (int): The number of processes sharing the operands of large sums in Expand, SimpleDerive and Substitute.
 
     Returns:
       The result of the execution.
@@ -94,8 +116,26 @@ def run_ir(ir: dict, args: list = [], trace_flag: bool = False):
         else:
             raise Exception(f"ERROR in args: Invalid argument {arg}")
 
-    # Execute the program
-    return interpreter(ir, args=processed_args, trace=trace_flag)
+    # Start every run with an empty cache of the given size
+    configure_memo(memo_size)
+    configure_identity(identity_error, seed)
+    configure_parallel(workers)
+
+    # Execute the program, stopping the worker processes it started
+    try:
+        return interpreter(ir, args=processed_args, trace=trace_flag)
+    finally:
+        PARALLEL.shutdown()
+
+
+def parse_identity_error(value: str):
+    """Parses the `--identity-error` option, a probability bound that is 0 or between 0 and 1."""
+    bound = float(value)
+    if bound != 0 and not 0 < bound < 1:
+        raise argparse.ArgumentTypeError(
+            f"must be 0 or between 0 and 1, but got {value}"
+        )
+    return bound
 
 
 if __name__ == "__main__":
@@ -130,6 +170,41 @@ if __name__ == "__main__":
         action="store_true",
         help="Print the trace of the stack interpreter during execution",
     )
+    run_parser.add_argument(
+        "-m",
+        "--memo-size",
+        type=int,
+        default=MEMO_SIZE,
+        help=f"Number of expression results to cache, 0 disables the cache (default: {MEMO_SIZE})",
+    )
+    run_parser.add_argument(
+        "-s",
+        "--memo-stats",
+        action="store_true",
+        help="Print the hit and miss statistics of the expression cache after execution",
+    )
+    run_parser.add_argument(
+        "-e",
+        "--identity-error",
+        type=parse_identity_error,
+        default=0,
+        help="Compare polynomials with == by evaluating them at random points, "
+        + "with the given probability of a wrong answer (default: 0, disabled)",
+    )
+    run_parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed of the random points of the identity test (default: 0)",
+    )
+    run_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of processes sharing the operands of large sums "
+        + "in Expand, SimpleDerive and Substitute (default: 1)",
+    )
 
     # Compile command
     compile_parser = subparsers.add_parser(
@@ -168,11 +243,15 @@ if __name__ == "__main__":
                 src = f.read()
 
             if args.command == "run":
-                print(
+                stdlib_print(
                     run_ir(
                         compile_source(src, args.optimize, args.ast),
                         args.args,
                         args.trace,
+                        args.memo_size,
+                        args.identity_error,
+                        args.seed,
+                        args.workers,
                     )
                 )
             elif args.command == "compile":
@@ -195,11 +274,24 @@ if __name__ == "__main__":
                 compiled_ir = json.load(f)
 
             if args.command == "run":
-                print(run_ir(compiled_ir, args.args, args.trace))
+                stdlib_print(
+                    run_ir(
+                        compiled_ir,
+                        args.args,
+                        args.trace,
+                        args.memo_size,
+                        args.identity_error,
+                        args.seed,
+                        args.workers,
+                    )
+                )
 
         else:
             raise Exception(f"ERROR: Unsupported file type: {args.file}")
 
+        if args.command == "run" and args.memo_stats:
+            print(f"Memo: {MEMO.stats()}")
+
     except FileNotFoundError as e:
         print(f"ERROR: {e}")
         sys.exit(1)
@@ -0,0 +1,483 @@
+import contextlib
+from fractions import Fraction
+from random import Random
+
+import pytest
+
+from src.interpreter.expression import (
+    MEMO,
+    PARALLEL,
+    add,
+    configure_identity,
+    configure_memo,
+    configure_parallel,
+    jacobian,
+    mul,
+    num,
+    pow,
+    sym,
+)
+from src.interpreter.stdlib import stdlib_eval_batch
+
+
+def test_interning():
+    x = sym("x")
+
+    assert add(x, 1) is add(1, "x")
+    assert mul(2, pow(x, 2)) is mul(pow("x", 2), 2)
+    assert hash(add(x, 1)) == hash(add(1, x))
+
+
+def test_substitute_root():
+    x = sym("x")
+
+    assert x.substitute(x, sym("y")) is sym("y")
+    assert add(x, 1).substitute(add(x, 1), num(2)) == 2
+
+
+def test_trusted_constructor(monkeypatch):
+    monkeypatch.setattr("src.interpreter.expression.DEBUG", True)
+    x, y = sym("x"), sym("y")
+
+    expr = mul(add(mul(3, x, y), pow(x, 2), -2), add(x, 1))
+
+    assert expr.expand() == add(
+        -2,
+        pow(x, 2),
+        pow(x, 3),
+        mul(-2, x),
+        mul(3, x, y),
+        mul(3, y, pow(x, 2)),
+    )
+    assert expr.simple_derive(x) == add(
+        -2,
+        pow(x, 2),
+        mul(3, x, y),
+        mul(add(1, x), add(mul(2, x), mul(3, y))),
+    )
+
+
+def test_expand_exponent_overflow():
+    x, y = sym("x"), sym("y")
+
+    assert pow(add(pow(x, 20000), y), 2).expand() == add(
+        pow(x, 40000), pow(y, 2), mul(2, y, pow(x, 20000))
+    )
+
+
+@pytest.mark.parametrize(
+    "base, exponent",
+    [
+        (add(1, "x", "y"), 7),
+        (add(1, "x", pow("x", 2)), 5),
+        (add("x", pow("y", Fraction(1, 2))), 4),
+    ],
+)
+def test_expand_power_of_sum(base, exponent):
+    expected = base
+    for _ in range(exponent - 1):
+        expected = mul(expected, base).expand()
+
+    assert pow(base, exponent).expand() == expected
+
+
+def test_expand_dense_univariate():
+    x = sym("x")
+    a = [(3 * i + 1) % 7 - 3 for i in range(60)]
+    b = [Fraction(i % 5, i % 3 + 1) for i in range(45)]
+
+    product = [0] * (len(a) + len(b) - 1)
+    for i, p in enumerate(a):
+        for j, q in enumerate(b):
+            product[i + j] += p * q
+
+    def polynomial(coefficients):
+        return add(*[mul(c, pow(x, k)) for k, c in enumerate(coefficients)])
+
+    expr = mul(polynomial(a), polynomial(b))
+
+    assert expr.expand() == polynomial(product)
+    assert expr.derive_polynomial(x) == polynomial(
+        [k * c for k, c in enumerate(product)][1:]
+    )
+
+
+def test_derive_sparse_univariate():
+    x = sym("x")
+    sparse = add(pow(x, 10**8), mul(3, pow(x, 7)), x)
+    derivative = add(mul(10**8, pow(x, 10**8 - 1)), mul(21, pow(x, 6)), 1)
+
+    assert sparse.simple_derive(x) is derivative
+    assert sparse.derive_polynomial(x) is derivative
+
+
+def test_normal_form_flags():
+    x, y = sym("x"), sym("y")
+    expanded = add(mul(3, pow(x, 2)), mul(x, y), 1)
+    product = mul(add(x, 1), y)
+
+    assert expanded._expanded and expanded._degree == 2
+    assert expanded.expand() is expanded
+    assert not product._expanded and product._degree == 2
+    assert pow(x, -1)._expanded and pow(x, -1)._degree == -1
+    assert not pow(add(x, 1), 2)._expanded
+
+    assert expanded.eval(num(2), num(5)) == num(23)
+    assert add(pow(x, 3), x).derive_polynomial(x) == add(mul(3, pow(x, 2)), 1)
+
+
+def test_expand_idempotent():
+    x, y, z = sym("x"), sym("y"), sym("z")
+    exponents = [2, 3, -1, -2, Fraction(1, 2), Fraction(-1, 2), Fraction(3, 2)]
+    # Numbers are positive, so that roots are only taken of symbolic negative bases
+    leaves = [x, y, z, mul(-1, x), num(2), num(Fraction(1, 2))]
+    rng = Random(0)
+
+    def tree(depth):
+        if depth == 0:
+            return rng.choice(leaves)
+        match rng.randrange(3):
+            case 0:
+                return add(*(tree(depth - 1) for _ in range(rng.randint(2, 3))))
+            case 1:
+                return mul(*(tree(depth - 1) for _ in range(rng.randint(2, 3))))
+            case _:
+                return pow(tree(depth - 1), rng.choice(exponents))
+
+    exprs = [
+        pow(add(pow(add(x, 1), -1), 1), 2),
+        pow(add(x, y), Fraction(-3, 2)),
+        pow(mul(x, pow(y, 2)), -2),
+        pow(mul(x, z), Fraction(3, 2)),
+    ]
+    expanded = []
+    while len(exprs) < 500:
+        # Sums cancelling to 0 raised to a negative power
+        with contextlib.suppress(ZeroDivisionError):
+            exprs.append(tree(rng.randint(1, 4)))
+    for e in exprs:
+        with contextlib.suppress(ZeroDivisionError):
+            expanded.append(e.expand())
+
+    assert len(expanded) >= 450
+    for e in expanded:
+        assert e._expanded
+        assert e.expand() is e
+
+
+def test_expand_product_base(monkeypatch):
+    monkeypatch.setattr("src.interpreter.expression.DEBUG", True)
+    x, y, z = sym("x"), sym("y"), sym("z")
+    root = pow(mul(x, y), Fraction(1, 2))
+
+    expanded = mul(add(1, root), root, z).expand()
+    assert expanded == add(mul(x, y, z), mul(z, root))
+    assert expanded.expand() is expanded
+    assert mul(2, expanded).expand() == add(mul(2, x, y, z), mul(2, z, root))
+
+
+def test_memo():
+    x, y = sym("x"), sym("y")
+    expr = mul(add(x, 1), add(y, 2))
+
+    configure_memo(2)
+    first = expr.expand()
+    assert expr.expand() is first
+    assert MEMO.hits == 1 and MEMO.misses == 1
+
+    expr.simple_derive(x)
+    expr.substitute(x, y)
+    assert len(MEMO.entries) == 2
+    misses = MEMO.misses
+    expr.expand()
+    assert MEMO.misses == misses + 1
+
+    # Expanded expressions are returned without touching the memo
+    stats = MEMO.stats()
+    assert first.expand() is first
+    assert MEMO.stats() == stats
+
+    configure_memo(0)
+    assert expr.expand() is first
+    assert MEMO.stats() == {"hits": 0, "misses": 0, "entries": 0, "max_entries": 0}
+
+    configure_memo()
+
+
+def test_substitute_all():
+    x, y, z = sym("x"), sym("y"), sym("z")
+    shared = pow(add(x, z), 2)
+    expr = add(mul(x, pow(y, 2)), shared)
+
+    assert expr.substitute_all({x: y, y: x}) == add(
+        mul(y, pow(x, 2)), pow(add(y, z), 2)
+    )
+    assert expr.substitute_all({x: num(1), y: num(2), z: num(3)}) == num(20)
+
+    unchanged = mul(shared, y)
+    assert any(o is shared for o in unchanged.substitute_all({y: z}).operands)
+    assert shared.substitute_all({y: x}) is shared
+
+
+def test_rational_roots():
+    x, y, z = sym("x"), sym("y"), sym("z")
+    expr = mul(
+        Fraction(-1, 3), pow(add(Fraction(-2, 3), pow(z, 2), mul(x, y)), Fraction(1, 2))
+    )
+
+    assert expr.eval(num(Fraction(2, 3)), num(1), num(Fraction(4, 3))) == num(
+        Fraction(-4, 9)
+    )
+    assert pow(Fraction(-27, 8), Fraction(-2, 3)) == num(Fraction(4, 9))
+    assert pow(10**60, Fraction(1, 3)) == num(10**20)
+    assert pow(2, Fraction(1, 2)) == num(2**0.5)
+
+
+def test_compile():
+    x, y = sym("x"), sym("y")
+    expr = add(mul(3, pow(x, 2)), pow(add(x, y), Fraction(-1, 2)), y)
+    evaluate = expr.compile()
+
+    assert expr.compile() is evaluate
+    assert evaluate(3, 1) == Fraction(57, 2)
+    assert evaluate(Fraction(1, 2), Fraction(7, 2)) == Fraction(19, 4)
+    for _ in range(3):
+        assert expr.eval(num(3), num(1)) == num(Fraction(57, 2))
+
+    with pytest.raises(ZeroDivisionError):
+        evaluate(1, -1)
+
+    # Sums and products too long for a single Python statement
+    long_sum = add(*[mul(k, pow(x, k), y) for k in range(1, 5000)])
+    for _ in range(3):
+        assert long_sum.eval(num(1), num(2)) == num(24995000)
+    long_product = mul(*[add(x, k) for k in range(1, 3000)])
+    assert long_product.compile()(-1) == 0
+
+
+def test_eval_batch():
+    x, y = sym("x"), sym("y")
+    expr = add(mul(x, y), pow(y, -1))
+    xs, ys = [1, 2, Fraction(1, 2)], [1, 4, 2]
+
+    assert list(expr.eval_batch(xs, ys)) == [2, Fraction(33, 4), Fraction(3, 2)]
+    assert list(num(Fraction(2, 3)).eval_batch()) == [Fraction(2, 3)]
+    assert list(add(x, 10**400).eval_batch([1], dtype=float)) == [float("inf")]
+    with pytest.raises(Exception, match="expression with symbols"):
+        stdlib_eval_batch(num(2), num(1), num(2))
+
+    numpy = pytest.importorskip("numpy")
+    values = expr.eval_batch(numpy.array(xs, dtype=float), numpy.array(ys), dtype=float)
+    assert values.dtype == numpy.float64
+    assert numpy.allclose(values, [2, 8.25, 1.5])
+
+
+def test_horner():
+    x, y = sym("x"), sym("y")
+    dense = add(mul(3, pow(x, 2)), mul(-2, x), Fraction(1, 2))
+    sparse = add(pow(x, 100), mul(5, pow(x, 37)), pow(x, 3))
+
+    assert dense.horner()(Fraction(1, 3)) == Fraction(1, 6)
+    assert sparse.horner()(-1) == -5
+    assert sparse.horner() is sparse.horner()
+    assert mul(add(x, 1), add(x, -1)).horner()(3) == 8
+    assert sparse.eval(num(2)) == num(2**100 + 5 * 2**37 + 8)
+
+    # Evaluated over the nonzero degrees only, and compact powers are not expanded
+    huge = add(pow(x, 10**8), mul(3, x), 1)
+    assert huge.horner()(1) == 5 and huge.eval(num(-1)) == num(-1)
+    power = pow(add(x, 1), 5000)
+    assert power.eval(num(1)) == num(2**5000)
+    assert "horner" not in power._cache
+
+    assert add(x, y).horner() is None
+    assert add(x, pow(x, -1)).horner() is None
+
+
+def test_deep_expressions():
+    x, y = sym("x"), sym("y")
+    chain, nested, roots = x, x, x
+    for _ in range(3000):
+        chain = pow(y, chain)
+        nested = add(mul(nested, y), x)
+        roots = pow(mul(2, add(roots, 1)), Fraction(1, 2))
+
+    assert chain.find_symbols() == {x, y}
+    assert pow(sym("foo"), chain).find_symbols() == {sym("foo"), x, y}
+    assert chain.substitute(x, num(0)) == chain.substitute(pow(y, x), num(1))
+    assert chain.print_tree().count("P(") == 3000
+    assert chain.print().count("^") == 3000
+
+    expanded = roots.expand()
+    assert expanded._expanded and expanded.print_tree().count("P(") == 3000
+    assert nested.simple_derive(x).substitute(y, num(0)) == num(1)
+    assert nested.eval(num(1), num(1)) == num(3001)
+
+    # Operands whose sort keys are nested deeper than the recursion limit
+    deep, other = x, sym("z")
+    for _ in range(5000):
+        deep, other = pow(y, deep), pow(y, other)
+    assert deep < other and not other < deep
+    assert add(deep, other).operands == (deep, other)
+    assert add(other, deep) is add(deep, other)
+    assert mul(other, deep) is pow(y, add(deep[1], other[1]))
+
+
+@pytest.mark.parametrize(
+    "expr,expected",
+    [
+        (add(1, mul(-1, sym("x"))), "1 - x"),
+        (add(1, mul(-1, pow(sym("x"), -1))), "1 - 1/x"),
+        (add(1, mul(-1, sym("x"), sym("y"))), "1 - x * y"),
+        (add(1, mul(-1, add(sym("x"), 2), sym("y"))), "1 - (2 + x) * y"),
+        (add(1, mul(-2, sym("x"))), "1 - 2 * x"),
+        (mul(-1, sym("x"), sym("y")), "-x * y"),
+        (mul(-1, pow(sym("x"), -2)), "-1/x^2"),
+    ],
+)
+def test_print(expr, expected):
+    assert expr.print() == expected
+
+
+def test_write():
+    import io
+
+    x = sym("x")
+    expr = add(*[mul(k - 500, pow(x, k)) for k in range(1, 1000)])
+
+    stream = io.StringIO()
+    expr.write(stream)
+    assert stream.getvalue() == expr.print()
+    assert stream.getvalue().startswith("x^501 - 499 * x - 498 * x^2")
+
+
+def test_equivalent():
+    x, y = sym("x"), sym("y")
+    product = mul(x, add(x, y), add(x, Fraction(-1, 2)))
+    expanded = product.expand()
+
+    configure_identity(0)
+    assert product.equivalent(product)
+    assert not product.equivalent(expanded)
+
+    configure_identity(1e-30, seed=1)
+    assert product.equivalent(expanded)
+    assert not product.equivalent(add(expanded, 1))
+    assert not product.equivalent(mul(expanded, x))
+    assert pow(add(x, y, 1), 40).equivalent(pow(add(x, y, 1), 40).expand())
+
+    # Expressions that are not polynomials are compared through their canonical form
+    inverse = pow(add(x, 1), -1)
+    assert not mul(x, inverse).equivalent(add(1, mul(-1, inverse)))
+    configure_identity(0)
+
+    for bound in (-1e-12, 1, float("nan")):
+        with pytest.raises(ValueError, match="Identity error bound"):
+            configure_identity(bound)
+    assert product.equivalent(product) and not product.equivalent(expanded)
+
+
+@pytest.mark.parametrize(
+    "expr",
+    [
+        pow(add(sym("x"), sym("y"), 10**40), 12),
+        pow(add(mul(3, sym("x")), mul(-2, sym("y")), Fraction(5, 7)), 15),
+        mul(
+            pow(add(sym("x"), Fraction(1, 3)), 40),
+            add(sym("x"), sym("y"), Fraction(-2, 5)),
+        ),
+        mul(add(sym("x"), -1), add(sym("x"), 1)),
+        pow(add(sym("x"), 1), Fraction(1, 2)),
+        pow(add(sym("foo"), 1), 3),
+        pow(add(pow(sym("x"), 20000), 1), 2),
+    ],
+)
+def test_expand_modular(expr):
+    assert expr.expand_modular() is expr.expand()
+
+
+def test_parallel():
+    x, y = sym("x"), sym("y")
+    expr = add(*[mul(k, pow(add(x, y, k), k % 4 + 1), pow(y, k)) for k in range(1, 40)])
+
+    expected = [expr.expand(), expr.simple_derive(x), expr.substitute(x, add(y, 1))]
+
+    configure_memo(7)
+    configure_parallel(2, threshold=8)
+    try:
+        assert expr.expand() is expected[0]
+        assert expr.simple_derive(x) is expected[1]
+        assert expr.substitute(x, add(y, 1)) is expected[2]
+        assert PARALLEL.executor.submit(_worker_memo_size).result() == 7
+    finally:
+        configure_parallel(1)
+        configure_memo()
+
+
+def _worker_memo_size():
+    """Returns the memo capacity of the process it runs in."""
+    return MEMO.max_entries
+
+
+def test_pickle():
+    import pickle
+
+    chain = sym("x")
+    for _ in range(5000):
+        chain = pow(sym("y"), chain)
+
+    assert pickle.loads(pickle.dumps(chain)) is chain
+
+
+def test_series():
+    x, y = sym("x"), sym("y")
+
+    assert pow(add(1, x), -1).series(x, 3) is add(
+        1, mul(-1, x), pow(x, 2), mul(-1, pow(x, 3))
+    )
+    assert pow(add(1, x), Fraction(1, 2)).series(x, 2) is add(
+        1, mul(Fraction(1, 2), x), mul(Fraction(-1, 8), pow(x, 2))
+    )
+    assert pow(add(1, x), 100000).series(x, 1) is add(1, mul(100000, x))
+    assert mul(pow(add(x, y), 3), add(x, 1)).series(x, 1) is add(
+        pow(y, 3), mul(x, pow(y, 3)), mul(3, x, pow(y, 2))
+    )
+
+    # Symbols that are not single letters share a bit of the free-symbol mask
+    ab, cd = sym("ab"), sym("cd")
+    assert mul(cd, add(1, ab)).series(ab, 1) is add(cd, mul(ab, cd))
+
+    with pytest.raises(Exception, match="non-zero constant term"):
+        pow(x, -1).series(x, 2)
+
+
+def test_coefficients():
+    x, y = sym("x"), sym("y")
+    expr = mul(pow(add(x, y, 1), 2), add(x, pow(x, -1)))
+
+    assert expr.coefficients(x) is expr.coefficients(x)
+    assert expr.degree(x) == 3 and expr.degree(y) == 2
+    assert expr._cache["degrees"] == {x: 3, y: 2}
+    assert expr.coefficient(x, 3) == 1
+    assert expr.coefficient(x, 2) is add(2, mul(2, y))
+    assert expr.coefficient(x, -1) is pow(add(1, y), 2).expand()
+    assert expr.coefficient(x, 5) == 0
+    assert expr.collect(x).expand() is expr.expand()
+    assert num(0).degree(x) == 0
+
+    with pytest.raises(Exception, match="not a sum of powers"):
+        pow(2, x).coefficients(x)
+
+
+def test_gradient():
+    x, y, z = sym("x"), sym("y"), sym("z")
+    expr = add(mul(x, pow(y, 2)), pow(add(x, z), Fraction(1, 2)))
+
+    assert expr.gradient() == tuple(expr.simple_derive(s) for s in (x, y, z))
+    assert num(3).gradient() == ()
+
+    rows = jacobian(mul(x, y), add(y, z))
+    assert rows == [[y, x, num(0)], [num(0), num(1), num(1)]]
+
+    with pytest.raises(Exception, match="Non-rational exponent"):
+        pow(x, y).gradient()
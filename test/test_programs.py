@@ -1,7 +1,16 @@
+import argparse
+
 import pytest
 
-from src.interpreter.expression import add, mul, pow
-from src.main import compile_source, run_ir
+from src.interpreter.expression import (
+    PARALLEL,
+    add,
+    configure_parallel,
+    mul,
+    pow,
+    sym,
+)
+from src.main import compile_source, parse_identity_error, run_ir
 
 
 @pytest.mark.parametrize(
@@ -95,3 +104,45 @@ def test_squared_terms(arg, expected_output):
         assert output == expected_output
 
         file.close()
+
+
+@pytest.mark.parametrize(
+    "identity_error, expected_output",
+    [
+        (0, add("a", "b")),
+        (1e-20, 0),
+    ],
+)
+def test_equivalent(identity_error, expected_output):
+    with open("test/test_src/programs/Equivalent.lpp", "r") as file:
+        src = file.read()
+
+        ir = compile_source(src)
+        output = run_ir(ir, identity_error=identity_error, seed=42)
+
+        assert output == expected_output
+
+        file.close()
+
+
+@pytest.mark.parametrize("identity_error", ["-1", "1", "nan"])
+def test_invalid_identity_error(identity_error):
+    with pytest.raises(argparse.ArgumentTypeError):
+        parse_identity_error(identity_error)
+
+
+def test_workers_shutdown(monkeypatch):
+    def interpreter(ir, args, trace):
+        # Sends a small sum to the pool, which run_ir started with 2 workers
+        PARALLEL.threshold = 2
+        assert add(mul("x", "y"), pow("y", 2)).simple_derive(sym("y")) is not None
+        assert PARALLEL.executor is not None
+        raise Exception("Program failed")
+
+    monkeypatch.setattr("src.main.interpreter", interpreter)
+    try:
+        with pytest.raises(Exception, match="Program failed"):
+            run_ir(compile_source("Main() { return 0 }"), workers=2)
+        assert PARALLEL.executor is None
+    finally:
+        configure_parallel(1)
@@ -0,0 +1,74 @@
+from fractions import Fraction
+
+import pytest
+
+from src.interpreter.expression import add, mul, num, pow, sym
+from src.interpreter.serialization import dump, dumps, load, loads
+
+
+@pytest.mark.parametrize(
+    "expr",
+    [
+        num(0),
+        num(-300),
+        num(Fraction(-7, 1000)),
+        sym("x"),
+        sym("velocità"),
+        add(sym("x"), mul(-2, sym("y"))),
+        pow(add(sym("x"), 1), Fraction(-1, 2)),
+        mul(add(sym("a"), sym("b")), pow(add(sym("a"), sym("b")), sym("c"))),
+    ],
+)
+def test_round_trip(expr):
+    assert loads(dumps(expr)) is expr
+
+
+def test_shared_subtrees():
+    expr = sym("x")
+    for _ in range(3000):
+        expr = add(mul(expr, expr), 1)
+
+    data = dumps(expr)
+
+    assert loads(data) is expr
+    assert len(data) < 3000 * 10
+
+
+def test_load(tmp_path):
+    expr = add(mul(3, sym("x")), pow(sym("y"), 2))
+    path = tmp_path / "expr.lpx"
+
+    with open(path, "wb") as file:
+        dump(expr, file)
+
+    assert load(path) is expr
+
+
+@pytest.mark.parametrize("length", [0, 4, 9])
+def test_load_corrupt(tmp_path, length):
+    path = tmp_path / "expr.lpx"
+    path.write_bytes(dumps(add(mul(3, sym("x")), pow(sym("y"), 2)))[:length])
+
+    with pytest.raises(Exception, match="Invalid serialized expression"):
+        load(path)
+
+
+@pytest.mark.parametrize(
+    "data",
+    [
+        b"",
+        b"LPX\x01",
+        b"LPX\x01\x01\x09",
+        b"LPX\x01\x02\x01\x01x\x02\x01\x05",
+        # Operand distances past the start of the table
+        b"LPX\x01\x03\x01\x01x\x01\x01y\x04\x02\x01\x03",
+        b"LPX\x01\x02\x01\x01x\x02\x01\x00",
+        # Nodes that are not in simplified form: a sum of x alone, x + x, 2^3
+        b"LPX\x01\x02\x01\x01x\x02\x01\x01",
+        b"LPX\x01\x02\x01\x01x\x02\x02\x01\x01",
+        b"LPX\x01\x03\x00\x04\x01\x00\x06\x01\x04\x02\x02\x01",
+    ],
+)
+def test_invalid(data):
+    with pytest.raises(Exception, match="Invalid serialized expression"):
+        loads(data)